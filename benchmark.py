@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+# Latency / memory benchmark of the RangeRet backbone variants
+
+import os
+import sys
+import time
+import copy
+import tempfile
+import argparse
+import yaml
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from network.rangeret import RangeRet, SemanticHead, ConvSemanticHead
+from network.retnet import RetNet
+from network.vit import VisionTransformer
+
+def measure(fn, iters, warmup, device):
+    '''
+    Mean latency (ms) and peak memory (MB, cuda only) of fn()
+    '''
+    for _ in range(warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(iters):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    latency = (time.time() - start) / iters * 1000
+    memory = torch.cuda.max_memory_allocated() / 2**20 if device.type == 'cuda' else float('nan')
+    return latency, memory, out
+
+def retention_backends(ARCH, FLAGS, device):
+    '''
+    Compare the retention backends of RetNet for each number of heads, with --fp16 return the
+    (heads, backend, error) whose error against fp32 is above --atol
+    '''
+    params = ARCH['model_params']
+    resolution = (ARCH['dataset']['sensor']['img_prop']['height'], ARCH['dataset']['sensor']['img_prop']['width'])
+    patched_image = RangeRet.get_patched_image(resolution, params['patch_size'], params['stride'])
+    retnet = params['retnet']
+
+    if FLAGS.patched_image is not None:
+        patched_image = tuple(FLAGS.patched_image)
+
+    print(f'Patched image {patched_image}, batch size {FLAGS.batch_size}')
+    print('{:>6} {:>10} {:>12} {:>12} {:>10} {:>10} {:>10}  {}'.format('heads', 'backend', 'latency(ms)', 'memory(MB)', 'speedup', 'max diff', 'fp32 diff', 'window radius'))
+
+    failures = []
+    for heads in FLAGS.heads:
+        x = torch.randn(FLAGS.batch_size, patched_image[0] * patched_image[1], retnet['model_dim'], device=device)
+        reference = None
+        for backend in FLAGS.backends:
+            torch.manual_seed(0)
+            model = RetNet(retnet['layers'], retnet['model_dim'], retnet['mlp_ratio'], heads, patched_image, retnet['double_v_dim'],
+                           retention_backend=backend,
+                           retention_type=FLAGS.retention_type or retnet.get('retention_type', 'full'),
+                           block_size=retnet.get('block_size', 512),
+                           window_size=retnet.get('window_size', 32),
+                           window_cutoff=retnet.get('window_cutoff', -20.0),
+                           linear_rank=retnet.get('linear_rank', 64),
+                           merge_ratio=FLAGS.merge_ratio if FLAGS.merge_ratio is not None else retnet.get('merge_ratio')).to(device).eval()
+            with torch.inference_mode(), torch.autocast(device.type, enabled=FLAGS.fp16):
+                latency, memory, out = measure(lambda: model(x), FLAGS.iters, FLAGS.warmup, device)
+            # error of the half precision path against the fp32 one of the same backend
+            fp32_diff = float('nan')
+            if FLAGS.fp16:
+                with torch.inference_mode():
+                    fp32_diff = (out.float() - model(x)).abs().max().item()
+                    if not fp32_diff <= FLAGS.atol:
+                        failures.append((heads, backend, fp32_diff))
+
+            radius = ''
+            if backend == 'window':
+                radius = model.retentions[0].get_window_radius(model.rel_mask)
+            if reference is None:
+                reference = (latency, out)
+            print('{:>6} {:>10} {:>12.2f} {:>12.1f} {:>9.2f}x {:>10.2e} {:>10.2e}  {}'.format(
+                heads, backend, latency, memory, reference[0] / latency, (out - reference[1]).abs().max().item(), fp32_diff, radius))
+    return failures
+
+def backbones(ARCH, FLAGS, device):
+    '''
+    Compare the RetNet backbone of the config with ViT backbones (SDPA attention) of the same
+    depth, width and number of heads for each spatial reduction ratio, on the same tokens
+    '''
+    params = ARCH['model_params']
+    resolution = (ARCH['dataset']['sensor']['img_prop']['height'], ARCH['dataset']['sensor']['img_prop']['width'])
+    patched_image = RangeRet.get_patched_image(resolution, params['patch_size'], params['stride'])
+    if FLAGS.patched_image is not None:
+        patched_image = tuple(FLAGS.patched_image)
+    retnet = params['retnet']
+
+    print(f'Patched image {patched_image} ({patched_image[0] * patched_image[1]} tokens), batch size {FLAGS.batch_size}')
+    print('{:>10} {:>10} {:>12} {:>12} {:>10}'.format('backbone', 'sr_ratio', 'latency(ms)', 'memory(MB)', 'speedup'))
+
+    x = torch.randn(FLAGS.batch_size, patched_image[0] * patched_image[1], retnet['model_dim'], device=device)
+    models = [('retnet', '-', RetNet(retnet['layers'], retnet['model_dim'], retnet['mlp_ratio'], retnet['num_head'], patched_image, retnet['double_v_dim'],
+                                     retention_backend=retnet.get('retention_backend', 'dense'), gate=retnet.get('gate', False)))]
+    for sr_ratio in FLAGS.sr_ratios:
+        models.append(('vit', sr_ratio, VisionTransformer(patched_image, retnet['model_dim'], retnet['layers'], retnet['num_head'], retnet['mlp_ratio'], sr_ratio=sr_ratio)))
+
+    reference = None
+    for name, sr_ratio, model in models:
+        model = model.to(device).eval()
+        with torch.inference_mode():
+            latency, memory, _ = measure(lambda: model(x), FLAGS.iters, FLAGS.warmup, device)
+        reference = reference or latency
+        print('{:>10} {:>10} {:>12.2f} {:>12.1f} {:>9.2f}x'.format(name, sr_ratio, latency, memory, reference / latency))
+
+def onnx_runtime(ARCH, FLAGS):
+    '''
+    Frames per second of the whole model (random weights) with eager PyTorch and with onnxruntime
+    on the same number of cpu threads, and the difference of their outputs
+    '''
+    from export import export_onnx
+    from modules.user import OnnxRuntimeModel
+
+    device = torch.device('cpu')
+    resolution = (ARCH['dataset']['sensor']['img_prop']['height'], ARCH['dataset']['sensor']['img_prop']['width'])
+    model = RangeRet(ARCH['model_params'], resolution, ARCH['dataset']['num_classes']).eval()
+    x = torch.randn(FLAGS.batch_size, model.in_dim, *resolution)
+    mask = torch.ones(FLAGS.batch_size, *resolution, dtype=torch.int32)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'rangeret.onnx')
+        export_onnx(model, resolution, path)
+
+        print(f'Range image {resolution}, batch size {FLAGS.batch_size}')
+        print('{:>8} {:>12} {:>12} {:>10} {:>10} {:>10}'.format('threads', 'backend', 'latency(ms)', 'frames/s', 'speedup', 'max diff'))
+        for threads in FLAGS.threads:
+            torch.set_num_threads(threads)
+            session = OnnxRuntimeModel(path, intra_op_threads=threads, inter_op_threads=1)
+            with torch.inference_mode():
+                eager, _, reference = measure(lambda: model(x, mask), FLAGS.iters, FLAGS.warmup, device)
+                latency, _, out = measure(lambda: session(x, mask), FLAGS.iters, FLAGS.warmup, device)
+            for backend, ms, output in (('torch', eager, reference), ('onnxruntime', latency, out)):
+                print('{:>8} {:>12} {:>12.2f} {:>10.2f} {:>9.2f}x {:>10.2e}'.format(
+                    threads, backend, ms, FLAGS.batch_size * 1000 / ms, eager / ms, (output - reference).abs().max().item()))
+
+def fusion(ARCH, FLAGS, device):
+    '''
+    Latency of the conv stem and of the whole model (random weights) before and after
+    RangeRet.fuse_for_inference, and the difference of their outputs
+    '''
+    resolution = (ARCH['dataset']['sensor']['img_prop']['height'], ARCH['dataset']['sensor']['img_prop']['width'])
+    model = RangeRet(ARCH['model_params'], resolution, ARCH['dataset']['num_classes']).to(device).eval()
+    fused = copy.deepcopy(model).fuse_for_inference()
+    x = torch.randn(FLAGS.batch_size, model.in_dim, *resolution, device=device)
+
+    print(f'Range image {resolution}, batch size {FLAGS.batch_size}')
+    print('{:>8} {:>10} {:>12} {:>10} {:>10}'.format('part', 'model', 'latency(ms)', 'speedup', 'max diff'))
+    with torch.inference_mode():
+        for part in ('stem', 'model'):
+            results = []
+            for name, m in (('original', model), ('fused', fused)):
+                fn = (lambda m=m: m.rem(x)) if part == 'stem' else (lambda m=m: m(x))
+                latency, _, out = measure(fn, FLAGS.iters, FLAGS.warmup, device)
+                results.append((name, latency, out))
+            for name, latency, out in results:
+                print('{:>8} {:>10} {:>12.2f} {:>9.2f}x {:>10.2e}'.format(
+                    part, name, latency, results[0][1] / latency, (out - results[0][2]).abs().max().item()))
+
+def layout_copies(fn, device):
+    '''
+    Number and size (MB) of the tensor copies of fn() (aten::clone, behind contiguous() and
+    the reshapes of non contiguous tensors)
+    '''
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if device.type == 'cuda' else [])
+    with profile(activities=activities, profile_memory=True) as prof:
+        fn()
+    for event in prof.key_averages():
+        if event.key == 'aten::clone':
+            if device.type == 'cpu':
+                memory = event.cpu_memory_usage
+            else:
+                memory = getattr(event, 'device_memory_usage', None) or event.cuda_memory_usage
+            return event.count, memory / 2**20
+    return 0, 0.0
+
+def memory_formats(ARCH, FLAGS, device):
+    '''
+    Latency, peak memory and layout copies of the whole model (random weights) with the convs
+    in NCHW and in channels_last, and the difference of their outputs
+    '''
+    resolution = (ARCH['dataset']['sensor']['img_prop']['height'], ARCH['dataset']['sensor']['img_prop']['width'])
+    results = []
+    for channels_last in (False, True):
+        arch = copy.deepcopy(ARCH)
+        arch['model_params']['channels_last'] = channels_last
+        torch.manual_seed(0)
+        model = RangeRet(arch['model_params'], resolution, arch['dataset']['num_classes']).to(device).eval()
+        x = torch.randn(FLAGS.batch_size, model.in_dim, *resolution, generator=torch.Generator().manual_seed(0)).to(device)
+        with torch.inference_mode():
+            latency, memory, out = measure(lambda: model(x), FLAGS.iters, FLAGS.warmup, device)
+            copies, copied = layout_copies(lambda: model(x), device)
+        results.append(('channels_last' if channels_last else 'NCHW', latency, memory, copies, copied, out))
+
+    print(f'Range image {resolution}, batch size {FLAGS.batch_size}')
+    print('{:>14} {:>12} {:>10} {:>8} {:>11} {:>10}'.format('layout', 'latency(ms)', 'memory(MB)', 'copies', 'copied(MB)', 'max diff'))
+    for name, latency, memory, copies, copied, out in results:
+        print('{:>14} {:>12.2f} {:>10.1f} {:>8} {:>11.1f} {:>10.2e}'.format(
+            name, latency, memory, copies, copied, (out - results[0][-1]).abs().max().item()))
+
+def semantic_heads(ARCH, FLAGS, device):
+    '''
+    Latency of the semantic head (nn.Linear against 1x1 convs, same weights) on the backbone
+    tokens and stem features of the sensor resolution, in NCHW and channels_last
+    '''
+    resolution = (ARCH['dataset']['sensor']['img_prop']['height'], ARCH['dataset']['sensor']['img_prop']['width'])
+    params = ARCH['model_params']
+    patched_image = RangeRet.get_patched_image(resolution, params['patch_size'], params['stride'])
+    dim = params['retnet']['model_dim']
+    x = torch.randn(FLAGS.batch_size, patched_image[0] * patched_image[1], dim, device=device)
+    rem = torch.randn(FLAGS.batch_size, dim, *resolution, device=device)
+
+    torch.manual_seed(0)
+    heads = {'mlp': SemanticHead(dim, params['decoder_dim'], *resolution, patched_image, ARCH['dataset']['num_classes'])}
+    heads['conv'] = ConvSemanticHead(dim, params['decoder_dim'], *resolution, patched_image, ARCH['dataset']['num_classes'])
+    heads['conv'].load_state_dict(heads['mlp'].state_dict())
+
+    print(f'Range image {resolution}, patched image {patched_image}, batch size {FLAGS.batch_size}')
+    print('{:>6} {:>14} {:>12} {:>10} {:>10} {:>10}'.format('head', 'layout', 'latency(ms)', 'memory(MB)', 'speedup', 'max diff'))
+    results = []
+    with torch.inference_mode():
+        for layout, memory_format in (('NCHW', torch.contiguous_format), ('channels_last', torch.channels_last)):
+            features = rem.contiguous(memory_format=memory_format)
+            for name, head in heads.items():
+                head = head.to(device, memory_format=memory_format).eval()
+                latency, memory, out = measure(lambda: head(x, features), FLAGS.iters, FLAGS.warmup, device)
+                results.append((name, layout, latency, memory, out))
+    for name, layout, latency, memory, out in results:
+        print('{:>6} {:>14} {:>12.2f} {:>10.1f} {:>9.2f}x {:>10.2e}'.format(
+            name, layout, latency, memory, results[0][2] / latency, (out - results[0][-1]).abs().max().item()))
+
+def streaming(ARCH, FLAGS, device):
+    '''
+    Accuracy loss of azimuth streaming (network/streaming.py) against the full frame: the same
+    random scan is streamed by slices of each width for a few rotations (a static scene), and
+    the max logit difference and the fraction of pixels with the same label are reported per
+    rotation. Uses the weights of --model if given, random ones otherwise
+    '''
+    from network.streaming import StreamingRangeRet
+
+    resolution = (ARCH['dataset']['sensor']['img_prop']['height'], ARCH['dataset']['sensor']['img_prop']['width'])
+    model = RangeRet(ARCH['model_params'], resolution, ARCH['dataset']['num_classes'])
+    if FLAGS.model is not None:
+        state_dict = torch.load(FLAGS.model, map_location='cpu')
+        model.load_state_dict(state_dict.get('model_state_dict', state_dict), strict=True)
+    model = model.to(device).eval()
+    x = torch.randn(FLAGS.batch_size, model.in_dim, *resolution, device=device)
+    with torch.no_grad():
+        reference = model(x)
+
+    print(f'Range image {resolution}, batch size {FLAGS.batch_size}')
+    print('{:>6} {:>9} {:>10} {:>10} {:>17}'.format('slice', 'rotation', 'max diff', 'labels', 'latency/slice(ms)'))
+    for width in FLAGS.stream:
+        streamer = StreamingRangeRet(model)
+        for rotation in range(FLAGS.rotations):
+            start = time.time()
+            out, _ = streamer(x, width)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            latency = (time.time() - start) / -(-resolution[1] // width) * 1000
+            same = (out.argmax(-1) == reference.argmax(-1)).float().mean().item()
+            print('{:>6} {:>9} {:>10.2e} {:>10.2%} {:>17.2f}'.format(
+                width, rotation + 1, (out - reference).abs().max().item(), same, latency))
+
+def segmentation(ARCH, DATA, FLAGS):
+    '''
+    Accuracy, mIoU and time per scan of a trained model on the valid split with each retention backend
+    '''
+    from modules.user import User
+
+    results = []
+    for backend in FLAGS.backends:
+        arch = copy.deepcopy(ARCH)
+        arch['model_params']['retnet']['retention_backend'] = backend
+        if FLAGS.merge_ratio is not None:
+            arch['model_params']['retnet']['merge_ratio'] = FLAGS.merge_ratio
+        print(f'Retention backend {backend}')
+        user = User(arch, DATA, FLAGS.dataset, None, FLAGS.model, 'valid', fp16=False)
+        acc, iou = user.infer_subset(loader=user.parser.get_valid_set(),
+                                     to_orig_fn=user.parser.to_original,
+                                     evaluator=user.evaluator)
+        results.append((backend, user.time_per_scan, acc.item(), iou.item()))
+
+    print('{:>10} {:>14} {:>8} {:>8}'.format('backend', 'time/scan(ms)', 'acc', 'mIoU'))
+    for backend, latency, acc, iou in results:
+        print('{:>10} {:>14.1f} {:>8.2%} {:>8.2%}'.format(backend, latency * 1000, acc, iou))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("./benchmark.py")
+    parser.add_argument(
+        '--config',
+        type=str,
+        required=False,
+        default='config/RangeRet-semantickitti.yaml',
+        help='Architecture yaml cfg file. See /config/ for sample. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--dataset', '-d',
+        type=str,
+        default=None,
+        help='Dataset to evaluate the mIoU of --model with each backend on the valid split. If not given, only the backbone latency is measured',
+    )
+    parser.add_argument(
+        '--data',
+        type=str,
+        default='config/labels/semantic-kitti.yaml',
+        help='Dataset yaml cfg file, used with --dataset. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--model', '-m',
+        type=str,
+        default=None,
+        help='Trained model to evaluate, used with --dataset (and its weights with --stream)',
+    )
+    parser.add_argument(
+        '--backends',
+        type=str,
+        nargs='+',
+        default=['dense', 'tiled', 'window'],
+        help='Retention backends to compare, the first one is the reference. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--retention_type',
+        type=str,
+        default=None,
+        help='Retention type (full, axial, decay) overriding the config one',
+    )
+    parser.add_argument(
+        '--patched_image',
+        type=int,
+        nargs=2,
+        default=None,
+        help='Patched image size (Hp Wp) overriding the one of the config, e.g. a small grid to check the backends',
+    )
+    parser.add_argument(
+        '--merge_ratio',
+        type=float,
+        nargs='+',
+        default=None,
+        help='Fraction of the tokens merged after each RetNet layer overriding the config one (0 to disable)',
+    )
+    parser.add_argument(
+        '--compare_vit',
+        action='store_true',
+        help='Compare the RetNet backbone with ViT backbones of the same size instead of the retention backends',
+    )
+    parser.add_argument(
+        '--sr_ratios',
+        type=int,
+        nargs='+',
+        default=[1, 2, 4],
+        help='Spatial reduction ratios of the ViT backbones compared with --compare_vit. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--onnxruntime',
+        action='store_true',
+        help='Compare frames/s of the whole model with eager PyTorch and onnxruntime on cpu instead of the retention backends',
+    )
+    parser.add_argument(
+        '--fuse',
+        action='store_true',
+        help='Compare the latency of the stem and of the whole model before and after BatchNorm folding instead of the retention backends',
+    )
+    parser.add_argument(
+        '--channels_last',
+        action='store_true',
+        help='Compare latency, peak memory and layout copies of the whole model with NCHW and channels_last convs instead of the retention backends',
+    )
+    parser.add_argument(
+        '--compare_heads',
+        action='store_true',
+        help='Compare the latency of the nn.Linear and 1x1 conv semantic heads instead of the retention backends',
+    )
+    parser.add_argument(
+        '--stream',
+        type=int,
+        nargs='+',
+        default=None,
+        help='Slice widths (columns) of azimuth streaming to compare with the full frame instead of the retention backends',
+    )
+    parser.add_argument(
+        '--rotations',
+        type=int,
+        default=3,
+        help='Rotations of the same scan streamed with --stream. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        nargs='+',
+        default=[torch.get_num_threads()],
+        help='Cpu threads of PyTorch and onnxruntime compared with --onnxruntime. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--fp16',
+        action='store_true',
+        help='Run the backends under autocast (float16 on cuda, bfloat16 on cpu) and report their error against fp32',
+    )
+    parser.add_argument(
+        '--atol',
+        type=float,
+        default=5e-2,
+        help='Max abs error against fp32 tolerated with --fp16, exits non-zero above it. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--heads',
+        type=int,
+        nargs='+',
+        default=[4],
+        help='Number of retention heads to benchmark. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--batch_size', '-b',
+        type=int,
+        default=1,
+        help='Batch size. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--iters',
+        type=int,
+        default=10,
+        help='Timed iterations. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--warmup',
+        type=int,
+        default=2,
+        help='Warmup iterations. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--device',
+        type=str,
+        default='cuda' if torch.cuda.is_available() else 'cpu',
+        help='Device to run on. Defaults to %(default)s',
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+
+    ARCH = yaml.safe_load(open(FLAGS.config, 'r'))
+    device = torch.device(FLAGS.device)
+
+    if FLAGS.dataset is not None:
+        assert FLAGS.model is not None, 'the mIoU comparison needs a trained --model'
+        DATA = yaml.safe_load(open(FLAGS.data, 'r'))
+        segmentation(ARCH, DATA, FLAGS)
+    elif FLAGS.onnxruntime:
+        onnx_runtime(ARCH, FLAGS)
+    elif FLAGS.fuse:
+        fusion(ARCH, FLAGS, device)
+    elif FLAGS.channels_last:
+        memory_formats(ARCH, FLAGS, device)
+    elif FLAGS.compare_heads:
+        semantic_heads(ARCH, FLAGS, device)
+    elif FLAGS.stream is not None:
+        streaming(ARCH, FLAGS, device)
+    elif FLAGS.compare_vit:
+        backbones(ARCH, FLAGS, device)
+    else:
+        failures = retention_backends(ARCH, FLAGS, device)
+        for heads, backend, error in failures:
+            print(f'{backend} backend with {heads} heads: error against fp32 {error:.2e} above --atol {FLAGS.atol:.2e}')
+        if failures:
+            sys.exit(1)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Export of a trained RangeRet to a self-contained graph (torch.export or TorchScript)
+
+import argparse
+import yaml
+import torch
+
+from network.rangeret import RangeRet
+
+def example_inputs(model, resolution, batch_size=1, device=torch.device('cpu')):
+    '''
+    Model in eval mode on device (the relative position buffers of the sensor patched image are
+    baked in the exported graph) and random (x, mask) inputs
+    '''
+    assert not model.token_pruning, 'token pruning keeps a data dependent number of tokens, disable it to export'
+    model = model.to(device).eval()
+
+    x = torch.randn(batch_size, model.in_dim, *resolution, device=device)
+    # same dtype as the proj_mask of the parsers
+    mask = torch.ones(batch_size, *resolution, dtype=torch.int32, device=device)
+    return model, (x, mask)
+
+def export(model, resolution, batch_size=1, format='export', device=torch.device('cpu')):
+    '''
+    Graph of model.forward(x, mask) for (B, C, H, W) range images of the sensor resolution, the
+    relative position tables of the backbone are constants of the graph. torch.export programs
+    take any batch (traced with a batch of at least 2, a batch of 1 would be specialized),
+    TorchScript graphs are static for batch_size
+    '''
+    if format == 'export':
+        model, inputs = example_inputs(model, resolution, max(batch_size, 2), device)
+        batch = torch.export.Dim('batch', min=1)
+        with torch.no_grad():
+            return torch.export.export(model, inputs, dynamic_shapes=({0: batch}, {0: batch}))
+    model, inputs = example_inputs(model, resolution, batch_size, device)
+    with torch.no_grad():
+        return torch.jit.trace(model, inputs)
+
+def export_onnx(model, resolution, path):
+    '''
+    ONNX graph of model.forward(proj_in, proj_mask) -> proj_output with a dynamic batch axis (on cpu).
+    proj_mask stays an input of the graph, it is only read when token pruning is on. Traced with a batch of 2: with
+    a batch of 1 the exporter can bake it in the reshapes of channels_last tensors
+    '''
+    model, inputs = example_inputs(model, resolution, batch_size=2)
+    with torch.no_grad():
+        torch.onnx.export(model, inputs, path, input_names=['proj_in', 'proj_mask'], output_names=['proj_output'],
+                          dynamic_axes={'proj_in': {0: 'batch'}, 'proj_mask': {0: 'batch'}, 'proj_output': {0: 'batch'}})
+
+def check_onnx(session, model, resolution, batch_size=2):
+    '''
+    Max absolute difference between the outputs of an onnxruntime session of the exported
+    model and of the PyTorch model for random inputs
+    '''
+    model, (x, mask) = example_inputs(model, resolution, batch_size)
+    feed = {'proj_in': x.numpy(), 'proj_mask': mask.numpy()}
+    output = session.run(None, {i.name: feed[i.name] for i in session.get_inputs()})[0]
+    with torch.no_grad():
+        return (torch.from_numpy(output) - model(x, mask)).abs().max().item()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("./export.py")
+    parser.add_argument(
+        '--config',
+        type=str,
+        required=False,
+        default='config/RangeRet-semantickitti.yaml',
+        help='Architecture yaml cfg file. See /config/ for sample. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--model', '-m',
+        type=str,
+        required=True,
+        help='Trained model to export',
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        required=True,
+        help='Exported model, .pt2 for torch.export, .ts for TorchScript or .onnx for ONNX (dynamic batch, cpu)',
+    )
+    parser.add_argument(
+        '--batch_size', '-b',
+        type=int,
+        default=1,
+        help='Batch size of the TorchScript graph (.pt2 and .onnx graphs take any batch). Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--device',
+        type=str,
+        default='cuda' if torch.cuda.is_available() else 'cpu',
+        help='Device to export on (TorchScript graphs stay on it). Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--fuse',
+        action='store_true',
+        help='Fold the BatchNorms of the stem and head in the neighbouring convs and linears before exporting',
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+
+    assert FLAGS.output.endswith(('.pt2', '.ts', '.onnx')), 'output must be a .pt2 (torch.export), .ts (TorchScript) or .onnx file'
+    ARCH = yaml.safe_load(open(FLAGS.config, 'r'))
+    device = torch.device(FLAGS.device)
+    resolution = (ARCH['dataset']['sensor']['img_prop']['height'], ARCH['dataset']['sensor']['img_prop']['width'])
+
+    model = RangeRet(ARCH['model_params'], resolution, ARCH['dataset']['num_classes'])
+    state_dict = torch.load(FLAGS.model, map_location=device)
+    model.load_state_dict(state_dict.get('model_state_dict', state_dict), strict=True)
+    if FLAGS.fuse:
+        model.eval().fuse_for_inference()
+
+    if FLAGS.output.endswith('.onnx'):
+        import onnxruntime as ort
+        export_onnx(model, resolution, FLAGS.output)
+        session = ort.InferenceSession(FLAGS.output, providers=['CPUExecutionProvider'])
+        print(f'Max difference between onnxruntime and PyTorch outputs: {check_onnx(session, model, resolution):.2e}')
+    elif FLAGS.output.endswith('.pt2'):
+        torch.export.save(export(model, resolution, FLAGS.batch_size, 'export', device), FLAGS.output)
+    else:
+        # the graph stays on the device it is traced on
+        export(model, resolution, FLAGS.batch_size, 'torchscript', device).save(FLAGS.output, _extra_files={'device': device.type})
+    print(f'Exported model saved in {FLAGS.output}')
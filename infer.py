@@ -67,6 +67,43 @@ if __name__ == '__main__':
 		default=False,
 		help='Use FP16 precision for inference. Default: False',
 	)
+	parser.add_argument(
+		'--stream',
+		type=int,
+		default=None,
+		help='Stream each scan by azimuth slices of this many columns. Default: None (full scan)',
+	)
+	parser.add_argument(
+		'--lookahead',
+		type=int,
+		default=0,
+		help='Columns the stem waits for before a streamed column is final. Default: 0',
+	)
+	parser.add_argument(
+		'--backend',
+		type=str,
+		default='torch',
+		choices=['torch', 'onnxruntime'],
+		help='Inference backend, onnxruntime runs an ONNX model (or exports --model to ONNX) on cpu. Default: torch',
+	)
+	parser.add_argument(
+		'--intra_op_threads',
+		type=int,
+		default=0,
+		help='Threads of an onnxruntime operator (0 for the onnxruntime default). Default: 0',
+	)
+	parser.add_argument(
+		'--inter_op_threads',
+		type=int,
+		default=0,
+		help='Threads running onnxruntime operators in parallel (0 for the onnxruntime default). Default: 0',
+	)
+	parser.add_argument(
+		'--fuse',
+		action='store_true',
+		default=False,
+		help='Fold the BatchNorms of the stem and head in the neighbouring convs and linears. Default: False',
+	)
 	FLAGS, unparsed = parser.parse_known_args()
 
 	# print summary of what we will do
@@ -80,6 +117,9 @@ if __name__ == '__main__':
 	print("split", FLAGS.split)
 	print("save", FLAGS.save)
 	print("fp16", FLAGS.fp16)
+	print("stream", FLAGS.stream)
+	print("backend", FLAGS.backend)
+	print("fuse", FLAGS.fuse)
 	print("----------\n")
 	# print("Commit hash (training version): ", str(
 	# 	subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()))
@@ -127,5 +167,6 @@ if __name__ == '__main__':
 		quit()
 
 	# create user and infer dataset
-	user = User(ARCH, DATA, FLAGS.dataset, FLAGS.log, FLAGS.model, FLAGS.split, FLAGS.save, FLAGS.fp16)
+	user = User(ARCH, DATA, FLAGS.dataset, FLAGS.log, FLAGS.model, FLAGS.split, FLAGS.save, FLAGS.fp16, FLAGS.stream, FLAGS.lookahead,
+				FLAGS.backend, FLAGS.intra_op_threads, FLAGS.inter_op_threads, FLAGS.fuse)
 	user.infer()
\ No newline at end of file
@@ -8,6 +8,7 @@ import torch
 import torch.nn as nn
 import torch.backends.cuda as cudnn
 import torch.nn.functional as F
+from torch.ao.quantization import enable_observer, disable_observer
 import matplotlib.pyplot as plt
 
 from utils.avgmeter import AverageMeter
@@ -25,7 +26,7 @@ from network.rangeret import RangeRet
 from dataloader.rangeaug import RangeAugmentation
 
 class Trainer():
-    def __init__(self, ARCH, DATA, datadir, logdir, checkpoint=None, pretrained=None, fp16=False):
+    def __init__(self, ARCH, DATA, datadir, logdir, checkpoint=None, pretrained=None, fp16=False, qat=False):
         # parameters
         self.ARCH = ARCH
         self.DATA = DATA
@@ -34,6 +35,8 @@ class Trainer():
         self.checkpoint = checkpoint
         self.pretrained = pretrained
         self.fp16 = fp16
+        self.qat = qat
+        self.quantization = self.ARCH['model_params'].get('quantization', {})
 
         # get data
         if self.ARCH['dataset']['pc_dataset_type'] == 'SemanticKITTI':
@@ -91,6 +94,18 @@ class Trainer():
         num_params = sum(p.numel() for p in self.model.parameters() if p.requires_grad)
         print(f'Number of parameters {num_params/1000000} M')
 
+        # quantization aware training: fine-tunes a float checkpoint with fake quantized weights and
+        # activations, the INT8 model (quantize.py) is exported at the end of the training
+        if self.qat:
+            assert self.checkpoint is not None and self.pretrained is None, 'quantization aware training fine-tunes a float checkpoint (--checkpoint)'
+            assert not self.fp16, 'fake quantization runs in fp32, disable --fp16'
+            assert not self.ARCH['model_params'].get('token_pruning', {}).get('use', False), 'token pruning keeps a data dependent number of tokens, disable it to export'
+            state_dict = torch.load(self.checkpoint, map_location='cpu')
+            self.model.load_state_dict(state_dict.get('model_state_dict', state_dict))
+            print(f'Float checkpoint loaded from {self.checkpoint}')
+            self.qat_linears = self.prepare_qat(self.model)
+            print(f'Quantization aware training, float layers: {self.quantization.get("float_layers") or []}')
+
         # GPU
         self.gpu = False
         self.multi_gpu = False
@@ -158,7 +173,7 @@ class Trainer():
             self.range_aug = RangeAugmentation(dataset=self.dataset_type)
 
         # Checkpoint model config
-        if self.checkpoint is not None:
+        if self.checkpoint is not None and not self.qat:
             try:
                 self.model.load_state_dict(torch.load(self.checkpoint))
                 print(f'Checkpoint loaded from {self.checkpoint}')
@@ -242,10 +257,44 @@ class Trainer():
 
         torch.save(self.model_single.state_dict(), os.path.join(self.logdir, f"{self.ARCH['model_params']['model_architecture']}-last.pt"))
 
+        if self.qat:
+            self.export_int8()
+
         print('Finished Training')
 
         return
 
+    def prepare_qat(self, model):
+        '''
+        Inserts the fake quantization of the quantization config in model (in place), returns the
+        names of the nn.Linear dynamically quantized at export
+        '''
+        from quantize import prepare_quantization
+        return prepare_quantization(model, self.quantization.get('engine', 'x86'), self.quantization.get('float_layers') or [],
+                                    qat=True, scores=self.quantization.get('scores', False))
+
+    def export_int8(self):
+        '''
+        Converts the best quantization aware trained weights (the last ones without validation) to
+        an INT8 TorchScript model for cpu inference ({arch}-int8.ts, loaded by infer.py --model)
+        '''
+        from quantize import convert_quantization
+        from export import export
+
+        arch = self.ARCH['model_params']['model_architecture']
+        best = os.path.join(self.logdir, f"{arch}-best.pt")
+        state_dict = torch.load(best, map_location='cpu') if os.path.isfile(best) else self.model_single.state_dict()
+        # fresh copy on cpu, without the sync batchnorm of multi gpu training
+        model = RangeRet(self.ARCH['model_params'], self.parser.get_resolution(), self.parser.get_n_classes())
+        linears = self.prepare_qat(model)
+        model.load_state_dict(state_dict)
+        model = convert_quantization(model.eval(), linears)
+
+        engine = self.quantization.get('engine', 'x86')
+        path = os.path.join(self.logdir, f"{arch}-int8.ts")
+        export(model, self.parser.get_resolution(), format='torchscript').save(path, _extra_files={'device': 'cpu', 'engine': engine})
+        print(f'INT8 model saved in {path}')
+
     def train_epoch(self, train_loader, model, criterion, optimizer, epoch, show_scans, color_fn, evaluator, scheduler):
         losses = AverageMeter()
         acc = AverageMeter()
@@ -255,6 +304,8 @@ class Trainer():
             torch.cuda.empty_cache()
 
         model.train()
+        if self.qat:
+            model.apply(enable_observer)
 
         for i, (in_vol, proj_mask, proj_labels, _, _, _, _, _, _, _, _, _, _, _, _) in tqdm(enumerate(train_loader), total=len(train_loader)):
             optimizer.zero_grad()
@@ -342,6 +393,9 @@ class Trainer():
 
         model.eval()
         evaluator.reset()
+        if self.qat:
+            # ranges are only calibrated on the training set
+            model.apply(disable_observer)
 
         with torch.no_grad():
             for i, (in_vol, _, proj_labels, _, _, _, _, _, _, _, _, _, _, _, _) in tqdm(enumerate(val_loader), total=len(val_loader)):
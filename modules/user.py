@@ -12,10 +12,51 @@ from utils.avgmeter import AverageMeter
 from utils.ioueval import iouEval
 from utils.knn import KNN
 
-from network.rangeret import RangeRet
+def load_exported(path, device):
+    '''
+    Model exported by export.py, a torch.export program (.pt2) or TorchScript (.ts): it runs
+    without the network package, relative position tables are constants of the graph.
+    Returns the model and its device: TorchScript graphs stay on the device they were traced
+    on (cpu for quantized models, which also need their quantized engine)
+    '''
+    if path.endswith('.pt2'):
+        program = torch.export.load(path)
+        try:
+            from torch.export.passes import move_to_device_pass
+        except ImportError:
+            # older torch (requirements.txt): move the module the program unlifts to
+            return program.module().to(device), device
+        return move_to_device_pass(program, device).module(), device
+    extra = {'device': '', 'engine': ''}
+    model = torch.jit.load(path, map_location='cpu', _extra_files=extra)
+    extra = {key: value.decode() if isinstance(value, bytes) else value for key, value in extra.items()}
+    if extra['engine']:
+        torch.backends.quantized.engine = extra['engine']
+    device = torch.device(extra['device'] or device)
+    return model.to(device), device
+
+class OnnxRuntimeModel(object):
+    '''
+    Model exported to ONNX run by an onnxruntime CPU session, called like the model on torch tensors.
+    0 threads lets onnxruntime choose
+    '''
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        # only the inputs declared by the graph are fed
+        self.inputs = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, proj_in, proj_mask=None):
+        feed = {'proj_in': proj_in, 'proj_mask': proj_mask}
+        output = self.session.run(None, {name: feed[name].cpu().numpy() for name in self.inputs})[0]
+        return torch.from_numpy(output)
 
 class User():
-    def __init__(self, ARCH, DATA, datadir, logdir, modeldir, split, save=False, fp16=False):
+    def __init__(self, ARCH, DATA, datadir, logdir, modeldir, split, save=False, fp16=False, stream=None, lookahead=0,
+                 backend='torch', intra_op_threads=0, inter_op_threads=0, fuse=False):
         # parameters
         self.ARCH = ARCH
         self.DATA = DATA
@@ -25,6 +66,8 @@ class User():
         self.split = split
         self.save = save
         self.fp16 = fp16
+        self.stream = stream
+        self.backend = backend
 
         # get data
         if self.ARCH['dataset']['pc_dataset_type'] == 'SemanticKITTI':
@@ -55,17 +98,48 @@ class User():
                              aug=False,
                              shuffle_train=False)
         
-        # load model
-        with torch.no_grad():
-            self.model = RangeRet(self.ARCH['model_params'], self.parser.get_resolution(), self.parser.get_n_classes())
+        # load model (exported graphs do not need the model code)
+        assert self.backend in ('torch', 'onnxruntime'), f'unknown inference backend {self.backend}'
+        if self.backend == 'onnxruntime':
+            assert not self.modeldir.endswith(('.pt2', '.ts')), 'onnxruntime runs ONNX models or state dicts (exported to ONNX)'
+        else:
+            assert not self.modeldir.endswith('.onnx'), 'ONNX models run with the onnxruntime backend'
+        self.exported = self.modeldir.endswith(('.pt2', '.ts', '.onnx')) or self.backend == 'onnxruntime'
+        assert self.stream is None or not self.exported, 'streaming inference needs the model code, not an exported graph'
+        self.device = torch.device("cuda" if torch.cuda.is_available() and self.backend == 'torch' else "cpu")
+        if self.modeldir.endswith(('.pt2', '.ts')):
+            self.model, self.device = load_exported(self.modeldir, self.device)
+        elif not self.modeldir.endswith('.onnx'):
+            from network.rangeret import RangeRet
+            with torch.no_grad():
+                self.model = RangeRet(self.ARCH['model_params'], self.parser.get_resolution(), self.parser.get_n_classes())
 
-        try:
-            #load model
-            self.model.load_state_dict(torch.load(self.modeldir), strict=True)
-            #self.model.load_state_dict(torch.load(self.modeldir, map_location=torch.device('cpu')), strict=True)
-        except:
-            # load model from checkpoint
-            self.model.load_state_dict(torch.load(self.modeldir)['model_state_dict'], strict=True)
+            try:
+                #load model
+                self.model.load_state_dict(torch.load(self.modeldir), strict=True)
+                #self.model.load_state_dict(torch.load(self.modeldir, map_location=torch.device('cpu')), strict=True)
+            except:
+                # load model from checkpoint
+                self.model.load_state_dict(torch.load(self.modeldir)['model_state_dict'], strict=True)
+
+            if fuse:
+                # BatchNorm folding, before an onnxruntime export
+                self.model.eval().fuse_for_inference()
+
+        if self.backend == 'onnxruntime':
+            onnx_path = self.modeldir
+            if not onnx_path.endswith('.onnx'):
+                # export the loaded model next to its weights
+                from export import export_onnx
+                onnx_path = os.path.splitext(self.modeldir)[0] + '.onnx'
+                export_onnx(self.model, self.parser.get_resolution(), onnx_path)
+                print(f'Model exported to {onnx_path}')
+            torch_model = self.model
+            self.model = OnnxRuntimeModel(onnx_path, intra_op_threads, inter_op_threads)
+            if not self.modeldir.endswith('.onnx'):
+                from export import check_onnx
+                print('Max difference between onnxruntime and PyTorch outputs: {:.2e}'.format(
+                    check_onnx(self.model.session, torch_model, self.parser.get_resolution())))
 
         # knn post processing
         self.post = None
@@ -75,13 +149,20 @@ class User():
         # GPU
         self.gpu = False
         self.model_single = self.model
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print('Infering in device: ', self.device)
-        if torch.cuda.is_available() and torch.cuda.device_count() > 0:
+        if self.device.type == 'cuda' and torch.cuda.device_count() > 0:
             cudnn.benchmark = True
             cudnn.fastest = True
             self.gpu = True
-            self.model.cuda()
+            if not self.exported:
+                self.model.cuda()
+
+        # azimuth streaming inference by slices of self.stream columns
+        self.streamer = None
+        if self.stream is not None:
+            from network.streaming import StreamingRangeRet
+            self.streamer = StreamingRangeRet(self.model, lookahead=lookahead)
+            print(f'Streaming inference by slices of {self.stream} columns')
 
         # evaluation (ignore class 0)
         self.eval = True # set False to produce only predictions
@@ -109,10 +190,13 @@ class User():
         print('Finished Infering')
 
     def infer_subset(self, loader, to_orig_fn, evaluator):        
-        # switch to evaluation mode
-        self.model.eval()
+        # switch to evaluation mode (exported graphs are exported in it)
+        if not self.exported:
+            self.model.eval()
 
         mean_time = AverageMeter()
+        stream_delay = AverageMeter()
+        last_seq = None
 
         evaluator.reset()
 
@@ -124,7 +208,7 @@ class User():
             end = time.time()
 
         with torch.inference_mode():
-            for i, (proj_in, _, _, unproj_labels, path_seq, path_name, p_x, p_y, proj_range, unproj_range, _, _, _, _, npoints) in tqdm(enumerate(loader), total=len(loader)):
+            for i, (proj_in, proj_mask, _, unproj_labels, path_seq, path_name, p_x, p_y, proj_range, unproj_range, _, _, _, _, npoints) in tqdm(enumerate(loader), total=len(loader)):
                 # first cut to rela size (batch size one allows it)
                 p_x = p_x[0, :npoints]
                 p_y = p_y[0, :npoints]
@@ -138,6 +222,7 @@ class User():
 
                 if self.gpu:
                     proj_in = proj_in.cuda()
+                    proj_mask = proj_mask.cuda()
                     p_x = p_x.cuda()
                     p_y = p_y.cuda()
                     unproj_labels = unproj_labels.cuda() if self.split != 'test' else None
@@ -146,7 +231,15 @@ class User():
                         unproj_range = unproj_range.cuda()
 
                 with torch.cuda.amp.autocast(enabled=self.fp16):
-                    proj_output = self.model(proj_in)
+                    if self.streamer is not None:
+                        # buffers of the previous scan act as the previous rotation
+                        if path_seq != last_seq:
+                            self.streamer.reset()
+                            last_seq = path_seq
+                        proj_output, delay = self.streamer(proj_in, self.stream)
+                        stream_delay.update(delay)
+                    else:
+                        proj_output = self.model(proj_in, proj_mask)
                     predictions = proj_output.permute(0, 3, 1, 2)
                     proj_argmax = predictions[0].argmax(dim=0)
 
@@ -186,7 +279,10 @@ class User():
                     pred_np.tofile(path)
 
         # print times
+        self.time_per_scan = mean_time.avg
         print('Inference time per scan: {:.3f}'.format(mean_time.avg))
+        if self.streamer is not None:
+            print('Latency from last slice to its labels: {:.4f}'.format(stream_delay.avg))
 
         # when done, do the evaluation
         if self.split != 'test':
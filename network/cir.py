@@ -0,0 +1,120 @@
+# Circular Retention (CiR) spatial decay on the patched range image
+#
+# The CiR bias between two patches only depends on their row difference, their
+# circular column difference and the head, so it is stored as a compact
+# (heads, Hp, Wp // 2 + 1) table and expanded by index gather when needed.
+
+import math
+import torch
+
+def cir_offsets(q_idx, k_idx, width):
+    '''
+    Row and circular column difference between flattened patch indices on a grid
+    with width columns (columns wrap around the azimuth), (..., len(q_idx), len(k_idx))
+    for indices batched along their leading dimensions
+    '''
+    row_diff = torch.abs(q_idx[..., :, None] // width - k_idx[..., None, :] // width)
+    col_diff = torch.abs(q_idx[..., :, None] % width - k_idx[..., None, :] % width)
+    col_diff = torch.minimum(col_diff, width - col_diff)  # circular distance
+    return row_diff, col_diff
+
+def cir_table(decay, img_dim):
+    '''
+    CiR bias table indexed by [head, row difference, circular column difference]
+
+    * decay: (heads,) log decay per head
+    * img_dim: shape of the patched image (Hp, Wp)
+
+    returns (heads, Hp, Wp // 2 + 1)
+    '''
+    slen = img_dim[0] * img_dim[1]
+    rows = torch.arange(img_dim[0]).to(decay)
+    cols = torch.arange(img_dim[1] // 2 + 1).to(decay)
+    dist = rows[:, None] + cols[None, :]
+    # exponential mapping
+    dist = (dist / dist.max()) ** 2 * (slen - 1)
+    return dist * decay[:, None, None]
+
+def cir_gather(table, width, q_idx, k_idx):
+    '''
+    CiR bias between query patches q_idx and key patches k_idx, (heads, len(q_idx), len(k_idx)),
+    or (B, heads, len(q_idx), len(k_idx)) for (B, n) indices
+    '''
+    row_diff, col_diff = cir_offsets(q_idx, k_idx, width)
+    return table[:, row_diff, col_diff].movedim(0, -3)
+
+def cir_expand(table, width):
+    '''
+    Dense (heads, Hp * Wp, Hp * Wp) CiR bias, gathered row and column wise so
+    that only (Hp, Hp) and (Wp, Wp) index tensors are created. Pass the table in
+    the dtype of the scores, the bias is created in the dtype of the table
+    '''
+    heads, height, _ = table.size()
+    rows = torch.arange(height, device=table.device)
+    cols = torch.arange(width, device=table.device)
+    row_diff = torch.abs(rows[:, None] - rows)
+    col_diff = torch.abs(cols[:, None] - cols)
+    col_diff = torch.minimum(col_diff, width - col_diff)  # circular distance
+
+    # broadcast indices gather (heads, Hp, Wp, Hp, Wp) directly in query-major order,
+    # the reshape is a view so the dense bias is the only full size tensor created
+    mask = table[:, row_diff[:, None, :, None], col_diff[None, :, None, :]]
+    return mask.reshape(heads, height * width, height * width)
+
+def cir_features(table, width, rank):
+    '''
+    Rank-`rank` symmetric factorization of the exponential CiR kernel of each head,
+    exp(bias)_ij ~ sum_s eigval[h, s] * feat[h, i, s] * feat[h, j, s].
+    The kernel is Toeplitz along the rows and circulant along the azimuth, so its
+    eigenvectors are an Hp eigenvector times a Fourier mode: one small eigh per
+    frequency gives the exact spectrum, truncated to the largest positive eigenvalues
+    (components with a negative eigenvalue could make the normalizer of linear retention
+    negative, they are dropped, and eigval is 0 if fewer than rank are positive).
+
+    returns eigval (heads, rank) and feat (heads, Hp * Wp, rank)
+    '''
+    heads, height, _ = table.size()
+    num_freq = width // 2 + 1
+    num_sin = (width - 1) // 2    # frequencies with a sin mode (not 0 and not the Nyquist one)
+    cols = torch.arange(width, device=table.device)
+    rows = torch.arange(height, device=table.device)
+
+    col_dist = torch.minimum(cols, width - cols)
+    kernel = torch.exp(table.double())[:, :, col_dist]                     # heads, Hp, Wp
+    spectrum = torch.fft.rfft(kernel, dim=-1).real                         # heads, Hp, num_freq
+    blocks = spectrum[:, torch.abs(rows[:, None] - rows)].permute(0, 3, 1, 2)  # heads, num_freq, Hp, Hp
+    eigval, eigvec = torch.linalg.eigh(blocks)
+
+    # candidates: cos modes of every frequency, then sin modes
+    candidates = torch.cat([eigval, eigval[:, 1:num_sin + 1]], dim=1).flatten(1)
+    top = candidates.topk(rank, dim=-1).indices                            # heads, rank
+    is_sin = top >= num_freq * height
+    freq = torch.where(is_sin, top // height - num_freq + 1, top // height)
+    k = top % height
+
+    head = torch.arange(heads, device=table.device)[:, None]
+    vec = eigvec[head, freq, :, k]                                         # heads, rank, Hp
+    angle = 2 * math.pi * freq[..., None].double() * cols / width          # heads, rank, Wp
+    mode = torch.where(is_sin[..., None], torch.sin(angle), torch.cos(angle))
+    norm = torch.where((freq == 0) | (2 * freq == width), 1.0, 2.0).double().sqrt() / math.sqrt(width)
+    feat = vec[..., :, None] * mode[..., None, :] * norm[..., None, None]  # heads, rank, Hp, Wp
+
+    return candidates.gather(1, top).clamp(min=0).to(table.dtype), feat.flatten(2).transpose(1, 2).to(table.dtype)
+
+def cir_spectrum(table, width):
+    '''
+    2D real FFT of the exponential CiR kernel of each head, for the convolutions of
+    the decay (non-softmax) retention. The azimuth axis is circular (length Wp), the
+    row axis is zero padded to 2 * Hp so that the convolution along it is linear.
+
+    returns (heads, 2 * Hp, Wp // 2 + 1) complex
+    '''
+    heads, height, _ = table.size()
+    rows = torch.arange(2 * height, device=table.device)
+    cols = torch.arange(width, device=table.device)
+    row_dist = torch.minimum(rows, 2 * height - rows)   # row 'height' has distance Hp, never reached
+    col_dist = torch.minimum(cols, width - cols)
+
+    kernel = torch.exp(table.float())[:, row_dist.clamp(max=height - 1)][..., col_dist]
+    kernel[:, height] = 0
+    return torch.fft.rfft2(kernel)
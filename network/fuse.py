@@ -0,0 +1,71 @@
+# BatchNorm folding for inference
+#
+# In eval mode a BatchNorm is a per channel affine map y * scale + shift. It is folded
+# in the layer before it when that layer is linear (conv or nn.Linear), in a 1x1 conv
+# after it (no padding, so the shift is exact everywhere), or, for the conv -> LeakyReLU
+# -> BatchNorm blocks of the stem, its positive scale goes through the LeakyReLU
+# (LeakyReLU(a * z) = a * LeakyReLU(z) for a > 0) and its shift in the next 1x1 conv.
+
+import torch
+from torch import nn
+
+def bn_affine(bn):
+    '''
+    (scale, shift) of the eval mode BatchNorm bn
+    '''
+    scale = bn.running_var.add(bn.eps).rsqrt()
+    if bn.affine:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        shift = shift + bn.bias
+    return scale, shift
+
+def channel_shape(layer):
+    # output channels first: (C_out, 1, ...) for convs, (C_out, 1) for nn.Linear
+    return (-1,) + (1,) * (layer.weight.dim() - 1)
+
+def scale_output(layer, scale, shift=None):
+    '''
+    layer (conv or nn.Linear) followed by its output * scale + shift, in place
+    '''
+    if layer.bias is None:
+        layer.bias = nn.Parameter(torch.zeros_like(scale))
+    layer.weight.mul_(scale.reshape(channel_shape(layer)))
+    layer.bias.mul_(scale)
+    if shift is not None:
+        layer.bias.add_(shift)
+
+def fold_before(layer, bn):
+    '''
+    Folds bn in the conv or nn.Linear layer it follows
+    '''
+    scale_output(layer, *bn_affine(bn))
+
+def fold_after(bn, conv, channels=slice(None)):
+    '''
+    Folds bn in the 1x1 conv it feeds, channels: input channels of conv coming from bn
+    (when bn is concatenated with other features)
+    '''
+    assert conv.kernel_size == (1, 1) and conv.padding == (0, 0) and conv.groups == 1, 'bn is only folded in a following 1x1 conv'
+    scale, shift = bn_affine(bn)
+    weight = conv.weight[:, channels, 0, 0]
+    if conv.bias is None:
+        conv.bias = nn.Parameter(torch.zeros(conv.out_channels, dtype=conv.weight.dtype, device=conv.weight.device))
+    conv.bias.add_(weight @ shift)
+    conv.weight[:, channels].mul_(scale[None, :, None, None])
+
+def fold_through_leaky_relu(conv, bn, next_conv):
+    '''
+    Folds the bn of conv -> LeakyReLU -> bn -> next_conv (1x1): its scale in conv and its shift
+    in next_conv. Returns False (nothing folded) if a scale is not positive
+    '''
+    scale, shift = bn_affine(bn)
+    if (scale <= 0).any():
+        return False
+    assert next_conv.kernel_size == (1, 1) and next_conv.padding == (0, 0) and next_conv.groups == 1, 'bn shift is only folded in a following 1x1 conv'
+    scale_output(conv, scale)
+    if next_conv.bias is None:
+        next_conv.bias = nn.Parameter(torch.zeros(next_conv.out_channels, dtype=next_conv.weight.dtype, device=next_conv.weight.device))
+    next_conv.bias.add_(next_conv.weight[:, :, 0, 0] @ shift)
+    return True
@@ -0,0 +1,109 @@
+# Token merging between RetNet layers, bipartite soft matching from ToMe (https://arxiv.org/pdf/2210.09461)
+
+import torch
+
+from network.cir import cir_gather
+
+class MergedTokens(object):
+    '''
+    Tokens of a batch after one or more merges
+
+    * source: (B, N) index of the merged token holding each patch of the patched image
+    * size: (B, n) number of patches of each merged token
+    * rep: (B, n) representative patch of each merged token, its position for the CiR bias and
+      the rotary embedding
+    * table: CiR table (heads, Hp, Wp // 2 + 1) of the patched image with width columns
+    * sin, cos: (B, n, key_dim) rotary position of each merged token (its representative patch)
+    '''
+    def __init__(self, source, size, rep, table, width, sin, cos):
+        self.source = source
+        self.size = size
+        self.rep = rep
+        self.table = table
+        self.width = width
+        self.sin = sin
+        self.cos = cos
+
+    @classmethod
+    def identity(cls, bsz, table, width, sin, cos):
+        '''
+        Unmerged tokens of the patched image of CiR table table
+        '''
+        seq_len = sin.size(0)
+        source = torch.arange(seq_len, device=sin.device).expand(bsz, seq_len)
+        size = sin.new_ones(bsz, seq_len)
+        return cls(source, size, source, table, width, sin.expand(bsz, *sin.shape), cos.expand(bsz, *cos.shape))
+
+    @property
+    def rel_pos(self):
+        '''
+        Relative position of the merged tokens for MultiScaleRetention: (B, heads, n, n) CiR bias
+        gathered from the table between representative patches, log(size) on the bias weights
+        each key by its number of patches (proportional attention)
+        '''
+        bias = cir_gather(self.table, self.width, self.rep, self.rep)
+        bias = bias.add_(self.size.log().to(bias)[:, None, None, :])
+        return ((self.sin[:, None], self.cos[:, None]), bias)
+
+    def merge(self, x):
+        '''
+        Features of the patches (B, N, C) to features of the merged tokens, mean over their patches
+        '''
+        out = x.new_zeros(x.size(0), self.size.size(1), x.size(-1))
+        out.scatter_add_(1, self.source[..., None].expand_as(x), x)
+        return out / self.size[..., None].to(x)
+
+    def unmerge(self, x):
+        '''
+        Features of the merged tokens (B, n, C) to the patches (B, N, C)
+        '''
+        return x.gather(1, self.source[..., None].expand(-1, -1, x.size(-1)))
+
+def bipartite_merge(metric, state, ratio):
+    '''
+    Merge a fraction ratio of the tokens: tokens are split alternately in two sets A and B,
+    each token of A is matched with its most similar token of B (cosine similarity of metric)
+    and the best matched ones are merged into their match (averaged, weighted by size)
+
+    * metric: (B, n, C) similarity features (retention keys)
+    * state: MergedTokens of the current tokens
+
+    returns the new MergedTokens and a function that merges features (B, n, C)
+    '''
+    bsz, seq_len, _ = metric.size()
+    num_a = (seq_len + 1) // 2
+    r = min(int(ratio * seq_len), num_a)
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        scores = metric[:, ::2] @ metric[:, 1::2].transpose(-1, -2)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)
+        unm_idx, src_idx = edge_idx[:, r:], edge_idx[:, :r]
+        dst_idx = node_idx.gather(1, src_idx)
+
+        # new token order: unmerged tokens of A, then tokens of B
+        num_unm = num_a - r
+        arange = torch.arange(seq_len - num_a, device=metric.device).expand(bsz, -1)
+        assign = metric.new_empty(bsz, seq_len, dtype=torch.long)
+        assign[:, ::2].scatter_(1, unm_idx, torch.arange(num_unm, device=metric.device).expand(bsz, -1))
+        assign[:, ::2].scatter_(1, src_idx, num_unm + dst_idx)
+        assign[:, 1::2] = num_unm + arange
+        rep = torch.cat([2 * unm_idx, 2 * arange + 1], dim=1)
+
+    new_len = seq_len - r
+    size = state.size.new_zeros(bsz, new_len).scatter_add_(1, assign, state.size)
+
+    def merge(x):
+        '''
+        Size weighted mean of the tokens of x (B, n, C)
+        '''
+        out = x.new_zeros(bsz, new_len, x.size(-1))
+        out.scatter_add_(1, assign[..., None].expand_as(x), x * state.size[..., None].to(x))
+        return out / size[..., None].to(x)
+
+    # merged tokens keep the position of their token of B (or of A if unmerged)
+    sin = state.sin.gather(1, rep[..., None].expand(-1, -1, state.sin.size(-1)))
+    cos = state.cos.gather(1, rep[..., None].expand(-1, -1, state.cos.size(-1)))
+
+    return MergedTokens(assign.gather(1, state.source), size, state.rep.gather(1, rep), state.table, state.width, sin, cos), merge
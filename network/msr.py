@@ -1,8 +1,13 @@
 # Multi-Scale Retention based on https://github.com/microsoft/torchscale/blob/main/torchscale/component/multiscale_retention.py
 
 import math
+from functools import partial
 import torch
 from torch import nn
+import torch.nn.functional as F
+
+from network.cir import cir_gather, cir_expand, cir_features, cir_spectrum
+from network.retention import retention_softmax, tiled_retention, chunkwise_retention, axial_retention, window_retention, linear_retention, fft_retention
 
 def rotate_every_two(x):
     x1 = x[:, :, :, ::2]
@@ -14,10 +19,24 @@ def theta_shift(x, sin, cos):
     return (x * cos) + (rotate_every_two(x) * sin)
 
 class MultiScaleRetention(nn.Module):
-    def __init__(self, hidden_size, heads, double_v_dim, num_patches):
+    def __init__(self, hidden_size, heads, double_v_dim, num_patches, backend='dense', block_size=512, retention_type='full',
+                 window_size=32, window_cutoff=-20.0, linear_rank=64, gate=False, head_index=None):
         """
         Multi-scale retention mechanism based on the paper
         "Retentive Network: A Successor to Transformer for Large Language Models"[https://arxiv.org/pdf/2307.08621.pdf]
+
+        backend 'dense' materializes the full score matrix, 'tiled' processes
+        block_size x block_size tiles with an online softmax, 'window' restricts
+        each head to the azimuth neighborhood where its CiR bias is above
+        window_cutoff (heads with a neighborhood as wide as the image stay dense),
+        'linear' is a kernelized approximation in O(seq_len) with a rank linear_rank
+        factorization of the CiR kernel (needs fine-tuning from dense checkpoints).
+        retention_type 'axial' replaces the full 2D retention with an azimuth
+        (circular) pass followed by a row pass, 'decay' uses the RetNet decay
+        (QK^T * exp(CiR)) without softmax, computed densely or with backend 'fft'
+        gate adds the swish output gate of RetNet (its projection is fused with q, k, v)
+        head_index: heads kept out of `heads` after head pruning (prune_heads.py), the
+        dimensions of a head and its decay do not change, only the kept ones are computed
         """
         super(MultiScaleRetention, self).__init__()
         self.hidden_size = hidden_size
@@ -26,15 +45,37 @@ class MultiScaleRetention(nn.Module):
         assert hidden_size % heads == 0, "hidden_size must be divisible by heads"
         self.head_size = self.v_dim // heads
         self.key_dim = self.hidden_size // self.heads
-        
+        # kept heads, q/k and v widths follow their number
+        self.pruned = head_index is not None and len(head_index) < heads
+        self.kept_heads = tuple(head_index if head_index is not None else range(heads))
+        self.register_buffer('head_index', torch.tensor(self.kept_heads), persistent=False)
+        self.heads = len(self.head_index)
+        self.qk_dim = self.heads * self.key_dim
+        self.v_dim = self.heads * self.head_size
+        self.backend = backend
+        self.block_size = block_size
+        self.retention_type = retention_type
+        self.window_size = window_size
+        self.window_cutoff = window_cutoff
+        self.window_radius = {}
+        self.linear_rank = linear_rank
+        self.linear_features = {}
+        self.decay_spectrum = {}
+        assert backend in ('dense', 'tiled', 'window', 'linear', 'fft'), f"unknown retention backend {backend}"
+        assert retention_type in ('full', 'axial', 'decay'), f"unknown retention type {retention_type}"
+        assert (backend == 'fft') <= (retention_type == 'decay'), "fft retention needs retention_type decay"
+        assert retention_type != 'decay' or backend in ('dense', 'fft'), f"decay retention supports the dense and fft backends, not {backend}"
+        assert retention_type != 'axial' or backend == 'dense', f"axial retention supports the dense backend, not {backend}"
+
         self.scaling = self.key_dim ** -0.5
 
-        self.swish = lambda x: x * torch.sigmoid(x)
-        self.q_proj = nn.Linear(self.hidden_size, self.hidden_size, bias=False)
-        self.k_proj = nn.Linear(self.hidden_size,self. hidden_size, bias=False)
-        self.v_proj = nn.Linear(self.hidden_size, self.v_dim, bias=False)
-        self.g_proj = nn.Linear(self.hidden_size, self.v_dim, bias=False)
+        self.gate = gate
+        # fused q, k, v (and g) projection
+        self.proj_sizes = [self.qk_dim, self.qk_dim, self.v_dim] + ([self.v_dim] if gate else [])
+        self.qkv_proj = nn.Linear(self.hidden_size, sum(self.proj_sizes), bias=False)
         self.out_proj = nn.Linear(self.v_dim, hidden_size, bias=False)
+        # fake quantization of the softmax scores of the dense backend (quantization aware training)
+        self.score_quant = nn.Identity()
 
         #self.group_norm = nn.GroupNorm(self.heads, self.v_dim)
         self.group_norm = RMSNorm(self.head_size, eps=1e-5, elementwise_affine=False)
@@ -42,31 +83,180 @@ class MultiScaleRetention(nn.Module):
         self.reset_parameters()
 
     def reset_parameters(self):
-        nn.init.xavier_uniform_(self.q_proj.weight, gain=2 ** -2.5)
-        nn.init.xavier_uniform_(self.k_proj.weight, gain=2 ** -2.5)
-        nn.init.xavier_uniform_(self.v_proj.weight, gain=2 ** -2.5)
-        nn.init.xavier_uniform_(self.g_proj.weight, gain=2 ** -2.5)
+        # same init as separate q, k, v, g projections
+        for weight in self.qkv_proj.weight.data.split(self.proj_sizes):
+            nn.init.xavier_uniform_(weight, gain=2 ** -2.5)
         nn.init.xavier_uniform_(self.out_proj.weight)
 
-    def parallel_forward(self, qr, kr, v, mask):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints with separate q, k, v, g projections
+        names = [prefix + f'{n}_proj.weight' for n in ('q', 'k', 'v', 'g')]
+        if names[0] in state_dict:
+            weights = [state_dict.pop(name) for name in names if name in state_dict]
+            state_dict[prefix + 'qkv_proj.weight'] = torch.cat(weights[:len(self.proj_sizes)], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def select_heads(self, mask):
+        '''
+        Relative position bias (or decay) of the kept heads, heads are the first dimension of
+        the CiR table, the dense bias and the decay, the second one of a merged tokens bias
+        '''
+        if not self.pruned:
+            return mask
+        return mask.index_select(max(mask.dim() - 3, 0), self.head_index)
+
+    def keys(self, x):
+        '''
+        Key projection of x (without scaling and rotation)
+        '''
+        return F.linear(x, self.qkv_proj.weight[self.qk_dim:2 * self.qk_dim])
+
+    def parallel_forward(self, qr, kr, v, mask, index=None, width=None, shared=None, bias_cache=None):
+        '''
+        index: (seq_len,) positions on the patched image of the tokens when only a
+        subset of them is kept (token pruning), width: Wp in that case
+        shared: optional dict where the score map is stored for the next layers (dense backend)
+        bias_cache: optional dict where the dense bias expanded from the table is kept for the next
+        layers of the same forward (dense backend)
+        '''
         bsz, seq_len, embed_dim = v.size()
 
-        vr = v.view(bsz, seq_len, self.heads, self.head_size).transpose(1, 2)
+        vr = v.reshape(bsz, seq_len, self.heads, self.head_size).transpose(1, 2)
+
+        is_table = index is not None or mask.size(-1) != seq_len or mask.size(-2) != seq_len
+        if index is not None:
+            assert self.retention_type == 'full' and self.backend in ('dense', 'tiled', 'linear'), \
+                "token pruning supports full retention with the dense, tiled and linear backends"
+        elif is_table:
+            # compact CiR table (heads, Hp, Wp // 2 + 1)
+            width = seq_len // mask.size(1)
+
+        if self.retention_type == 'axial':
+            assert is_table, "axial retention needs the CiR table"
+            output = axial_retention(qr, kr, vr, mask, (mask.size(1), width))
+            return output.transpose(1, 2)
+
+        if self.retention_type == 'decay':
+            assert is_table, "decay retention needs the CiR table"
+            output = self.decay_forward(qr, kr, vr, mask, width)
+            return output.transpose(1, 2)
+
+        if self.backend == 'tiled':
+            assert is_table, "tiled retention needs the CiR table"
+            if index is None:
+                bias_fn = partial(cir_gather, mask, width)
+            else:
+                bias_fn = lambda q_idx, k_idx: cir_gather(mask, width, index[q_idx], index[k_idx])
+            output = tiled_retention(qr, kr, vr, bias_fn, self.block_size)
+            return output.transpose(1, 2)
+
+        if self.backend == 'window':
+            assert is_table, "window retention needs the CiR table"
+            output = self.window_forward(qr, kr, vr, mask, width)
+            return output.transpose(1, 2)
+
+        if self.backend == 'linear':
+            assert is_table, "linear retention needs the CiR table"
+            eigval, feat = self.get_linear_features(mask, width)
+            if index is not None:
+                feat = feat[:, index]
+            output = linear_retention(qr, kr, vr, eigval, feat)
+            return output.transpose(1, 2)
 
         qk_mat = qr @ kr.transpose(-1, -2) # bsz * m * seq_len * seq_len
+        # bias created in the dtype of the scores (half under autocast) and added in place,
+        # the scores are never upcast, the softmax accumulates in fp32
+        key = (qk_mat.dtype, self.kept_heads)
+        if is_table and bias_cache is not None and key in bias_cache:
+            mask = bias_cache[key]
+        elif is_table:
+            mask = mask.to(qk_mat.dtype)
+            if index is not None:
+                mask = cir_gather(mask, width, index, index)
+            else:
+                mask = cir_expand(mask, width)
+            if bias_cache is not None:
+                bias_cache[key] = mask
+        else:
+            mask = mask.to(qk_mat.dtype)
         # qk_mat = qk_mat * mask
-        qk_mat = qk_mat + mask
-        qk_mat = torch.softmax(qk_mat, dim=-1)  # bsz * m * seq_len * seq_len
+        qk_mat = qk_mat.add_(mask)
+        qk_mat = self.score_quant(retention_softmax(qk_mat))  # bsz * m * seq_len * seq_len
+        if shared is not None:
+            shared["scores"] = qk_mat
         # invariant after normalization
         # qk_mat = qk_mat / qk_mat.detach().sum(dim=-1, keepdim=True).abs().clamp(min=1)
         output = torch.matmul(qk_mat, vr)
         output = output.transpose(1, 2)
         return output
 
+    def _apply(self, fn, *args, **kwargs):
+        # tensors derived from the CiR table follow the buffers of RetNet, rebuild them after a move or a cast
+        self.window_radius.clear()
+        self.linear_features.clear()
+        self.decay_spectrum.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def get_window_radius(self, table):
+        '''
+        Azimuth radius per head beyond which the CiR bias is below window_cutoff
+        '''
+        key = tuple(table.size())
+        if key not in self.window_radius:
+            # bias decreases with the column difference, row difference 0 is the upper bound
+            radius = (table[:, 0] >= self.window_cutoff).sum(dim=-1) - 1
+            self.window_radius[key] = radius.tolist()
+        return self.window_radius[key]
+
+    def get_linear_features(self, table, width):
+        '''
+        Low rank factorization of the CiR kernel used by the linear backend
+        '''
+        key = (tuple(table.size()), width, table.device, table.dtype)
+        if key not in self.linear_features:
+            self.linear_features[key] = cir_features(table, width, min(self.linear_rank, table.size(1) * width))
+        return self.linear_features[key]
+
+    def decay_forward(self, qr, kr, vr, table, width):
+        if self.backend == 'fft':
+            key = (tuple(table.size()), width, table.device)
+            if key not in self.decay_spectrum:
+                self.decay_spectrum[key] = cir_spectrum(table, width)
+            return fft_retention(qr, kr, vr, self.decay_spectrum[key], (table.size(1), width))
+
+        decay = torch.exp(cir_expand(table, width))
+        decay = decay / decay.sum(dim=-1, keepdim=True).sqrt()
+        qk_mat = (qr @ kr.transpose(-1, -2)) * decay
+        qk_mat = qk_mat / qk_mat.detach().sum(dim=-1, keepdim=True).abs().clamp(min=1)
+        return torch.matmul(qk_mat, vr)
+
+    def window_forward(self, qr, kr, vr, mask, width):
+        outputs = []
+        for h, radius in enumerate(self.get_window_radius(mask)):
+            head = slice(h, h + 1)
+            if self.window_size + 2 * radius >= width:
+                # head needs global context
+                qk_mat = qr[:, head] @ kr[:, head].transpose(-1, -2)
+                qk_mat = qk_mat.add_(cir_expand(mask[head].to(qk_mat.dtype), width))
+                outputs.append(retention_softmax(qk_mat) @ vr[:, head])
+            else:
+                outputs.append(window_retention(qr[:, head], kr[:, head], vr[:, head], mask[head], width, radius, self.window_size))
+        return torch.cat(outputs, dim=1)
+
+    def chunkwise_forward(self, qr, kr, v, mask, chunk_size):
+        bsz, seq_len, embed_dim = v.size()
+
+        vr = v.reshape(bsz, seq_len, self.heads, self.head_size).transpose(1, 2)
+
+        assert mask.size(-1) != seq_len, "chunkwise retention needs the CiR table"
+        assert self.retention_type != 'decay', "chunkwise retention needs the softmax retention"
+        output = chunkwise_retention(qr, kr, vr, mask, seq_len // mask.size(1), chunk_size)
+        return output.transpose(1, 2)
+
     def recurrent_forward(self, qr, kr, v, decay, incremental_state):
         bsz = v.size(0)
 
-        v = v.view(bsz, self.heads, self.head_size, 1)
+        v = v.reshape(bsz, self.heads, self.head_size, 1)
         kv = kr * v
         if "prev_key_value" in incremental_state:
             prev_kv = incremental_state["prev_key_value"]
@@ -83,31 +273,96 @@ class MultiScaleRetention(nn.Module):
         output = torch.sum(qr * kv, dim=3)
         return output
 
-    def forward(self, x, rel_pos, incremental_state=None):
+    def project(self, x, sin, cos):
         bsz, seq_len, _ = x.size()
-        (sin, cos), inner_mask = rel_pos
 
-        q = self.q_proj(x)
-        k = self.k_proj(x)
-        v = self.v_proj(x)
-        g = self.g_proj(x)
+        q, k, v, *g = self.qkv_proj(x).split(self.proj_sizes, dim=-1)
+        g = g[0] if self.gate else None
 
-        k *= self.scaling
-        q = q.view(bsz, seq_len, self.heads, self.key_dim).transpose(1, 2)
-        k = k.view(bsz, seq_len, self.heads, self.key_dim).transpose(1, 2)
+        k = k * self.scaling
+        q = q.reshape(bsz, seq_len, self.heads, self.key_dim).transpose(1, 2)
+        k = k.reshape(bsz, seq_len, self.heads, self.key_dim).transpose(1, 2)
 
         qr = theta_shift(q, sin, cos)
         kr = theta_shift(k, sin, cos)
 
-        if incremental_state is not None:
+        return qr, kr, v, g
+
+    def stream_forward(self, x, rel_pos, idx, valid, incremental_state):
+        """
+        Retention of the tokens idx (a few azimuth columns of a streamed scan) against
+        the key/value ring buffer of the whole patched image kept in incremental_state.
+        Keys of positions not marked in valid (never received) are ignored.
+        """
+        bsz, seq_len, _ = x.size()
+        (sin, cos), inner_mask = rel_pos
+        inner_mask = self.select_heads(inner_mask)
+        assert self.retention_type == 'full', "streaming needs full retention"
+
+        qr, kr, v, g = self.project(x, sin[idx], cos[idx])
+        vr = v.reshape(bsz, seq_len, self.heads, self.head_size).transpose(1, 2)
+
+        if "key" not in incremental_state:
+            incremental_state["key"] = kr.new_zeros(bsz, self.heads, sin.size(0), self.key_dim)
+            incremental_state["value"] = vr.new_zeros(bsz, self.heads, sin.size(0), self.head_size)
+        incremental_state["key"][:, :, idx] = kr
+        incremental_state["value"][:, :, idx] = vr
+
+        index = torch.arange(sin.size(0), device=x.device)
+        mask = cir_gather(inner_mask, sin.size(0) // inner_mask.size(1), idx, index)
+        mask = mask.masked_fill(~valid, float('-inf'))
+
+        qk_mat = qr @ incremental_state["key"].transpose(-1, -2) + mask
+        qk_mat = torch.softmax(qk_mat, dim=-1)
+        output = torch.matmul(qk_mat, incremental_state["value"]).transpose(1, 2)
+
+        return self.output(output, g)
+
+    def forward(self, x, rel_pos, incremental_state=None, chunk_size=None, index=None, shared=None, bias_cache=None):
+        """
+        index: optional positions on the patched image of the tokens in x (pruned tokens),
+        rel_pos is always the one of the whole patched image
+        shared: optional dict shared by a group of layers, the first one stores its score
+        map there and the others reuse it (only V and the projections are computed)
+        bias_cache: optional dict shared by the layers of a forward to expand the CiR table once
+        """
+        bsz, seq_len, _ = x.size()
+        (sin, cos), inner_mask = rel_pos
+        inner_mask = self.select_heads(inner_mask)
+
+        if shared is not None and "scores" in shared:
+            v, *g = F.linear(x, self.qkv_proj.weight[2 * self.qk_dim:]).split(self.proj_sizes[2:], dim=-1)
+            g = g[0] if self.gate else None
+            vr = v.reshape(bsz, seq_len, self.heads, self.head_size).transpose(1, 2)
+            output = torch.matmul(shared["scores"], vr).transpose(1, 2)
+            return self.output(output, g)
+
+        if index is not None:
+            qr, kr, v, g = self.project(x, sin[index], cos[index])
+        else:
+            qr, kr, v, g = self.project(x, sin, cos)
+
+        if index is not None:
+            output = self.parallel_forward(qr, kr, v, inner_mask, index, sin.size(0) // inner_mask.size(1), shared=shared, bias_cache=bias_cache)
+        elif incremental_state is not None:
             output = self.recurrent_forward(qr, kr, v, inner_mask, incremental_state)
+        elif chunk_size is not None:
+            output = self.chunkwise_forward(qr, kr, v, inner_mask, chunk_size)
         else:
-            output = self.parallel_forward(qr, kr, v, inner_mask)
+            output = self.parallel_forward(qr, kr, v, inner_mask, shared=shared, bias_cache=bias_cache)
+
+        return self.output(output, g)
 
+    def output(self, output, g):
+        '''
+        Normalization, gate and output projection of the retention output (bsz, seq_len, heads, head_size)
+        and the gate g (bsz, seq_len, v_dim)
+        '''
         #output = self.group_norm(output.reshape(seq_len, self.head_size * self.heads)).reshape(bsz, seq_len, self.head_size * self.heads)
-        output = self.group_norm(output).reshape(bsz, seq_len, self.head_size * self.heads)
+        output = self.group_norm(output).reshape(output.size(0), -1, self.head_size * self.heads)
 
-        # output = self.swish(g) * output
+        if self.gate:
+            output = F.silu(g) * output
 
         output = self.out_proj(output)
 
@@ -3,10 +3,12 @@
 import math
 import torch
 from torch import nn
+import torch.nn.functional as F
 
-from network.retnet import RetNet
+from network.retnet import RetNet, HierarchicalRetNet
 from network.vision_embedding import VisionEmbedding
 from network.stem import ConvStem
+from network.fuse import fold_before, fold_after
 
 from network.vit import VisionTransformer
 
@@ -27,6 +29,10 @@ class BasicConv2d(nn.Module):
         x = self.gelu(x)
         return x
 
+    def fuse_for_inference(self):
+        fold_before(self.conv, self.norm)
+        self.norm = nn.Identity()
+
 class MLP(nn.Module):
     def __init__(self, in_dim, out_dim, prob=0.0):
         super(MLP, self).__init__()
@@ -100,16 +106,31 @@ class REM(nn.Module):
 
         return x
 
+    def fuse_for_inference(self):
+        '''
+        Folds the BatchNorm of each BasicConv2d in its conv, the input BatchNorm feeds a
+        zero padded conv and stays
+        '''
+        for conv in self.convs:
+            conv.fuse_for_inference()
+
 class SemanticHead(nn.Module):
     '''
     Semantic Head: two MLP layers to map feature dimension into number of classes
     '''
-    def __init__(self, in_dim, hidden_dim, height, width, patched_img, num_classes, dropout=0.0):
+    def __init__(self, in_dim, hidden_dim, height, width, patched_img, num_classes, dropout=0.0, stages=None):
+        '''
+        stages: optional list of (dim, patched image) of the later stages of a hierarchical backbone,
+        their features are projected to in_dim and added at the resolution of the first stage
+        '''
         super(SemanticHead, self).__init__()
         self.height = height
         self.width = width
         self.patched_img = patched_img
 
+        self.stage_imgs = [img for _, img in stages or []]
+        self.fuse = nn.ModuleList([nn.Linear(dim, in_dim) for dim, _ in stages or []])
+
         self.mlp1 = nn.Linear(in_dim, hidden_dim)
         self.gelu = nn.GELU()
         self.mlp2 = nn.Linear(hidden_dim, num_classes)
@@ -134,19 +155,43 @@ class SemanticHead(nn.Module):
             if m.bias is not None:
                 m.bias.data.zero_()
 
-    def forward(self, x, rem):
+    def forward(self, x, rem, patched_img=None, stage_imgs=None):
+        '''
+        patched_img, stage_imgs: patched image (of each later stage) if the input image
+        size is not the one of the model, the output has the size of rem
+        '''
+        patched_img = patched_img or self.patched_img
+        stage_imgs = stage_imgs or self.stage_imgs
+        size = tuple(rem.shape[-2:]) if rem is not None else (self.height, self.width)
+
+        # multi-scale features of a hierarchical backbone
+        if isinstance(x, (list, tuple)):
+            x, stages = x[0], x[1:]
+        else:
+            stages = []
+
         # reshape to 2d from (B, N, C) to (B, H, W, C)
-        x = torch.reshape(x, (x.shape[0], self.patched_img[0], self.patched_img[1], x.shape[2]))
+        x = torch.reshape(x, (x.shape[0], patched_img[0], patched_img[1], x.shape[-1]))
         # reshape to (B, C, H, W)
         x = x.permute(0, 3, 1, 2)
 
+        for feat, img, fuse in zip(stages, stage_imgs, self.fuse):
+            feat = fuse(feat).reshape(x.shape[0], *img, -1).permute(0, 3, 1, 2)
+            x = x + torch.nn.functional.interpolate(feat, size=tuple(patched_img), mode='bilinear')
+
         # bilinear interpolation
-        x = torch.nn.functional.interpolate(x, size=(self.height, self.width), mode='bilinear')
+        x = torch.nn.functional.interpolate(x, size=size, mode='bilinear')
 
         # residual connection with REM output
         if rem is not None:
             x = x + rem
 
+        return self.project(x)
+
+    def project(self, x):
+        '''
+        Map the upsampled features (B, C, H, W) to class logits (B, H, W, num_classes)
+        '''
         # reshape to (B, H, W, C)
         x = x.permute(0, 2, 3, 1)
 
@@ -160,7 +205,84 @@ class SemanticHead(nn.Module):
         x = self.mlp2(x)
 
         return x
+
+    def fuse_for_inference(self):
+        '''
+        Folds the BatchNorm in mlp1
+        '''
+        fold_before(self.mlp1, self.norm)
+        self.norm = nn.Identity()
     
+class ConvSemanticHead(SemanticHead):
+    '''
+    SemanticHead with 1x1 convolutions, in the layout of the features (no full resolution permute):
+    mlp1 is applied to the tokens before the bilinear upsampling (both are linear and the upsampling
+    weights sum to 1) and to the residual from the stem, only hidden_dim channels are upsampled.
+    Loads SemanticHead weights
+    '''
+    def __init__(self, in_dim, hidden_dim, height, width, patched_img, num_classes, dropout=0.0, stages=None):
+        super(ConvSemanticHead, self).__init__(in_dim, hidden_dim, height, width, patched_img, num_classes, dropout, stages)
+        self.mlp1 = nn.Conv2d(in_dim, hidden_dim, kernel_size=1)
+        self.mlp2 = nn.Conv2d(hidden_dim, num_classes, kernel_size=1)
+        # initialized as the nn.Linear of SemanticHead
+        for conv in (self.mlp1, self.mlp2):
+            trunc_normal_(conv.weight, std=.02)
+            nn.init.constant_(conv.bias, 0)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # SemanticHead checkpoints (nn.Linear weights)
+        for name in (prefix + 'mlp1.weight', prefix + 'mlp2.weight'):
+            if name in state_dict and state_dict[name].dim() == 2:
+                state_dict[name] = state_dict[name][:, :, None, None]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, rem, patched_img=None, stage_imgs=None):
+        patched_img = patched_img or self.patched_img
+        stage_imgs = stage_imgs or self.stage_imgs
+        size = tuple(rem.shape[-2:]) if rem is not None else (self.height, self.width)
+
+        # multi-scale features of a hierarchical backbone
+        if isinstance(x, (list, tuple)):
+            x, stages = x[0], x[1:]
+        else:
+            stages = []
+
+        # (B, N, C) tokens as a (B, C, Hp, Wp) channels_last view
+        x = x.reshape(x.shape[0], patched_img[0], patched_img[1], x.shape[-1]).permute(0, 3, 1, 2)
+
+        for feat, img, fuse in zip(stages, stage_imgs, self.fuse):
+            feat = fuse(feat).reshape(x.shape[0], *img, -1).permute(0, 3, 1, 2)
+            x = x + F.interpolate(feat, size=tuple(patched_img), mode='bilinear')
+
+        # mlp1 on the patched image, its bias is added once with the residual
+        x = F.conv2d(x, self.mlp1.weight, self.mlp1.bias if rem is None else None)
+        # upsampled in the layout of the stem output
+        if rem is not None and rem.is_contiguous(memory_format=torch.channels_last):
+            x = x.contiguous(memory_format=torch.channels_last)
+        else:
+            x = x.contiguous()
+        x = F.interpolate(x, size=size, mode='bilinear')
+
+        if rem is not None:
+            x = self.mlp1(rem).add_(x)
+
+        return self.classify(x)
+
+    def project(self, x):
+        '''
+        Map the upsampled features (B, C, H, W) to class logits (B, H, W, num_classes)
+        '''
+        return self.classify(self.mlp1(x))
+
+    def classify(self, x):
+        '''
+        Class logits (B, H, W, num_classes) of the mlp1 output (B, hidden_dim, H, W)
+        '''
+        x = self.norm(x)
+        x = self.gelu(x)
+        x = self.mlp2(x)
+        return x.permute(0, 2, 3, 1)
+
 class Decoder(nn.Module):
     '''
     Head inspired by RangeViT: https://arxiv.org/pdf/2301.10222
@@ -198,6 +320,14 @@ class Decoder(nn.Module):
         
         return x
 
+    def fuse_for_inference(self):
+        '''
+        Folds the BatchNorm after the LeakyReLU in the 1x1 output conv
+        '''
+        fold_after(self.conv1[2], self.out)
+        self.conv1[2] = nn.Identity()
+        self.conv1[1].inplace = True
+
 class RangeRet(nn.Module):
     def __init__(self, model_params: dict, resolution, num_classes=20, activate_recurrent=False):
         super(RangeRet, self).__init__()
@@ -226,11 +356,27 @@ class RangeRet(nn.Module):
         self.mlp_ratio = model_params['retnet']['mlp_ratio']
         self.num_head = model_params['retnet']['num_head']
         self.double_v_dim = model_params['retnet']['double_v_dim']
+        self.retention_backend = model_params['retnet'].get('retention_backend', 'dense')
+        self.block_size = model_params['retnet'].get('block_size', 512)
+        self.rel_pos_cache = model_params['retnet'].get('rel_pos_cache', None)
+        self.retention_type = model_params['retnet'].get('retention_type', 'full')
+        self.window_size = model_params['retnet'].get('window_size', 32)
+        self.window_cutoff = model_params['retnet'].get('window_cutoff', -20.0)
+        self.linear_rank = model_params['retnet'].get('linear_rank', 64)
+        self.merge_ratio = model_params['retnet'].get('merge_ratio', None)
+        self.score_sharing = model_params['retnet'].get('score_sharing', None)
+        self.gate = model_params['retnet'].get('gate', False)
+        self.shape_cache_mb = model_params['retnet'].get('shape_cache_mb', 256)
+        self.kept_heads = model_params['retnet'].get('kept_heads', None)
+
+        # drop the tokens of (almost) empty patches
+        self.token_pruning = model_params.get('token_pruning', {}).get('use', False)
+        self.min_valid = model_params.get('token_pruning', {}).get('min_valid', 0.0)
 
         assert self.dim == self.model_dim, 'conv stem dim must be equal to model dim'
+        assert not self.token_pruning or self.bb == 'retnet', 'token pruning needs the RetNet backbone'
 
-        self.patched_image = (math.floor((self.H - self.patch_size[0]) / self.stride[0]) + 1,
-                              math.floor((self.W - self.patch_size[1]) / self.stride[1]) + 1)
+        self.patched_image = self.get_patched_image((self.H, self.W), self.patch_size, self.stride)
 
         print(f'Patched image size = {self.patched_image}')
 
@@ -239,23 +385,112 @@ class RangeRet(nn.Module):
         
         self.viembed = VisionEmbedding(self.H, self.W, self.patch_size, self.dim, self.model_dim, self.stride, self.pool) # H, W, patch size, input channel, output features
         
-        if self.bb == 'retnet':
-            self.backbone = RetNet(self.layers, self.model_dim, self.mlp_ratio, self.num_head, self.patched_image, self.double_v_dim, self.drop_path_rate, activate_recurrent=activate_recurrent) #layers=4, hidden_dim=128, ffn_size=256, num_head=4, (patched_image_h, patched_image_w), v_dim=double
+        # hierarchical RetNet
+        self.stages = model_params['retnet'].get('stages', None)
+        assert not self.token_pruning or self.stages is None, 'token pruning needs the single stage RetNet'
+        assert self.kept_heads is None or (self.bb == 'retnet' and self.stages is None), 'head pruning needs the single stage RetNet'
+        assert self.stages is None or (self.merge_ratio is None and self.score_sharing is None), \
+            'token merging and score sharing need the single stage RetNet'
+        assert not self.token_pruning or not any(self.merge_ratio or []), \
+            'token merging and token pruning can not be used together'
+
+        if self.bb == 'retnet' and self.stages is not None:
+            assert self.stages['dims'][0] == self.model_dim, 'first stage dim must be equal to model dim'
+            self.backbone = HierarchicalRetNet(self.stages['depths'], self.stages['dims'], self.stages['heads'], self.stages['downsample'],
+                                               self.mlp_ratio, self.patched_image, self.double_v_dim, self.drop_path_rate,
+                                               retention_backend=self.retention_backend, block_size=self.block_size,
+                                               rel_pos_cache=self.rel_pos_cache, retention_type=self.retention_type,
+                                               window_size=self.window_size, window_cutoff=self.window_cutoff,
+                                               linear_rank=self.linear_rank, gate=self.gate, shape_cache_mb=self.shape_cache_mb)
+        elif self.bb == 'retnet':
+            self.backbone = RetNet(self.layers, self.model_dim, self.mlp_ratio, self.num_head, self.patched_image, self.double_v_dim, self.drop_path_rate, activate_recurrent=activate_recurrent,
+                                   retention_backend=self.retention_backend, block_size=self.block_size,
+                                   rel_pos_cache=self.rel_pos_cache, retention_type=self.retention_type,
+                                   window_size=self.window_size, window_cutoff=self.window_cutoff,
+                                   linear_rank=self.linear_rank, merge_ratio=self.merge_ratio,
+                                   score_sharing=self.score_sharing, gate=self.gate, shape_cache_mb=self.shape_cache_mb,
+                                   kept_heads=self.kept_heads) #layers=4, hidden_dim=128, ffn_size=256, num_head=4, (patched_image_h, patched_image_w), v_dim=double
         elif self.bb == 'vit':
-            self.backbone = VisionTransformer(self.patched_image, self.model_dim, self.layers, self.num_head, self.mlp_ratio, drop_path_rate=self.drop_path_rate)
+            vit = model_params.get('vit', {})
+            self.backbone = VisionTransformer(self.patched_image, self.model_dim, self.layers, self.num_head, self.mlp_ratio, drop_path_rate=self.drop_path_rate,
+                                              sr_ratio=vit.get('sr_ratio', 1), sr_ratios=vit.get('sr_ratios', None))
         
-        self.head = SemanticHead(self.model_dim, self.decoder_dim, self.H, self.W, self.patched_image, self.num_classes)
+        stages = None
+        if isinstance(self.backbone, HierarchicalRetNet):
+            stages = list(zip(self.backbone.dims[1:], self.backbone.img_dims[1:]))
+        # semantic head with nn.Linear or 1x1 convs (same weights)
+        self.head_type = model_params.get('head', 'mlp')
+        assert self.head_type in ('mlp', 'conv'), f'unknown head {self.head_type}'
+        head = ConvSemanticHead if self.head_type == 'conv' else SemanticHead
+        self.head = head(self.model_dim, self.decoder_dim, self.H, self.W, self.patched_image, self.num_classes, stages=stages)
         #self.head = Decoder(self.model_dim, self.decoder_dim, self.H, self.W, self.patched_image, self.num_classes)
+
+        # convs in channels_last (NHWC), the layout of the (B, N, C) tokens: the patch embedding, the
+        # depthwise convs, the head and the residual from the stem use views instead of layout copies
+        self.channels_last = model_params.get('channels_last', False)
+        if self.channels_last:
+            self.to(memory_format=torch.channels_last)
     
-    def forward(self, x):
+    @staticmethod
+    def get_patched_image(resolution, patch_size, stride):
+        '''
+        Shape of the token grid (Hp, Wp) for a range image of shape resolution
+        '''
+        return (math.floor((resolution[0] - patch_size[0]) / stride[0]) + 1,
+                math.floor((resolution[1] - patch_size[1]) / stride[1]) + 1)
+
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        '''
+        Folds the BatchNorms of the stem and head in the neighbouring convs and linears where the
+        result is exact (network/fuse.py), in place and for inference only: the running statistics
+        are used and the state dict changes. Returns the model
+        '''
+        assert not self.training, 'BatchNorm folding uses the running statistics, call eval() first'
+        self.rem.fuse_for_inference()
+        self.head.fuse_for_inference()
+        return self
+
+    def get_kept_tokens(self, mask):
+        '''
+        Positions on the patched image of the patches with more than min_valid valid pixels
+        in mask (B, H, W), shared by the batch (union over the samples)
+        '''
+        valid = F.avg_pool2d(mask[:, None].float(), self.patch_size, self.stride)
+        keep = (valid.flatten(1) > self.min_valid).any(dim=0)
+        return keep.nonzero().squeeze(1)
+
+    def forward(self, x, mask=None):
+        '''
+        x: (B, C, H, W) range image, of any size (the patched image follows it)
+        mask: (B, H, W) valid pixels (proj_mask), used by token pruning. If not given,
+        valid pixels are the non zero ones (empty pixels of the projection are zeroed)
+        '''
+        patched_image = self.get_patched_image(x.shape[-2:], self.patch_size, self.stride)
+        stage_images = None
+        if isinstance(self.backbone, HierarchicalRetNet):
+            stage_images = self.backbone.get_img_dims(patched_image)[1:]
+
+        index = None
+        if self.token_pruning:
+            index = self.get_kept_tokens(mask if mask is not None else x.ne(0).any(dim=1))
+
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         x = self.rem(x)
 
         residual = x
         
         x = self.viembed(x)
 
-        x = self.backbone(x)
+        if index is not None:
+            # pruned tokens skip the backbone
+            tokens = x
+            x = tokens.clone()
+            x[:, index] = self.backbone(tokens[:, index], index=index, img_dim=patched_image)
+        else:
+            x = self.backbone(x, img_dim=patched_image)
 
-        x = self.head(x, residual)
+        x = self.head(x, residual, patched_image, stage_images)
 
         return x
\ No newline at end of file
@@ -0,0 +1,277 @@
+# Memory efficient retention kernels used by MultiScaleRetention
+
+import math
+import torch
+import torch.nn.functional as F
+
+from network.cir import cir_gather
+
+def retention_softmax(scores):
+    '''
+    Softmax over the keys of half precision scores without an fp32 copy of them: autocast would
+    upcast the whole matrix, the softmax kernels already accumulate max and sum in fp32
+    and write the result in the dtype of the scores
+    '''
+    if scores.dtype in (torch.float16, torch.bfloat16):
+        with torch.autocast(scores.device.type, enabled=False):
+            return torch.softmax(scores, dim=-1)
+    return torch.softmax(scores, dim=-1)
+
+def online_softmax_init(q, value_dim):
+    '''
+    Running max, normalizer and output of an online softmax for the queries q
+    '''
+    m = q.new_full(q.shape[:-1], float('-inf'), dtype=torch.float32)
+    l = q.new_zeros(q.shape[:-1], dtype=torch.float32)
+    acc = q.new_zeros((*q.shape[:-1], value_dim), dtype=torch.float32)
+    return m, l, acc
+
+def online_softmax_update(state, s, v):
+    '''
+    Add the scores s (..., queries, keys) of a block of keys with values v to the state
+    '''
+    m, l, acc = state
+    m_new = torch.maximum(m, s.amax(dim=-1))
+    p = torch.exp(s - m_new[..., None])
+    alpha = torch.exp(m - m_new)
+    l = l * alpha + p.sum(dim=-1)
+    acc = acc * alpha[..., None] + (p.to(v.dtype) @ v).float()
+    return m_new, l, acc
+
+class TiledRetention(torch.autograd.Function):
+    '''
+    softmax(QK^T + bias) V computed by (query, key) blocks with an online softmax.
+    The bias of each tile is created by bias_fn only when the tile is processed and
+    tiles are recomputed in the backward pass, so the seq_len x seq_len score matrix
+    is never stored and memory grows linearly with the sequence length.
+
+    * qr, kr: (bsz, heads, seq_len, key_dim)
+    * vr: (bsz, heads, seq_len, head_size)
+    * bias_fn: callable (q_idx, k_idx) -> (heads, len(q_idx), len(k_idx))
+    * block_size: number of queries/keys per tile
+    '''
+    @staticmethod
+    def forward(ctx, qr, kr, vr, bias_fn, block_size):
+        bsz, heads, seq_len, _ = qr.size()
+        index = torch.arange(seq_len, device=qr.device)
+
+        out = qr.new_empty(bsz, heads, seq_len, vr.size(-1), dtype=torch.float32)
+        lse = qr.new_empty(bsz, heads, seq_len, dtype=torch.float32)
+
+        for qs in range(0, seq_len, block_size):
+            qe = min(qs + block_size, seq_len)
+            q = qr[:, :, qs:qe]
+
+            state = online_softmax_init(q, vr.size(-1))
+            for ks in range(0, seq_len, block_size):
+                ke = min(ks + block_size, seq_len)
+                s = (q @ kr[:, :, ks:ke].transpose(-1, -2)).float() + bias_fn(index[qs:qe], index[ks:ke])
+                state = online_softmax_update(state, s, vr[:, :, ks:ke])
+
+            m, l, acc = state
+            out[:, :, qs:qe] = acc / l[..., None]
+            lse[:, :, qs:qe] = m + torch.log(l)
+
+        ctx.save_for_backward(qr, kr, vr, out, lse)
+        ctx.bias_fn = bias_fn
+        ctx.block_size = block_size
+
+        return out.to(vr.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        qr, kr, vr, out, lse = ctx.saved_tensors
+        bias_fn, block_size = ctx.bias_fn, ctx.block_size
+        seq_len = qr.size(2)
+        index = torch.arange(seq_len, device=qr.device)
+
+        # tiles are recomputed in fp32 (autocast is not active in backward)
+        grad_out = grad_out.float()
+        delta = (grad_out * out).sum(dim=-1)
+
+        dq = torch.zeros_like(qr, dtype=torch.float32)
+        dk = torch.zeros_like(kr, dtype=torch.float32)
+        dv = torch.zeros_like(vr, dtype=torch.float32)
+
+        for qs in range(0, seq_len, block_size):
+            qe = min(qs + block_size, seq_len)
+            q = qr[:, :, qs:qe].float()
+            do = grad_out[:, :, qs:qe]
+
+            for ks in range(0, seq_len, block_size):
+                ke = min(ks + block_size, seq_len)
+                k = kr[:, :, ks:ke].float()
+                v = vr[:, :, ks:ke].float()
+
+                s = q @ k.transpose(-1, -2) + bias_fn(index[qs:qe], index[ks:ke])
+                p = torch.exp(s - lse[:, :, qs:qe, None])
+
+                dv[:, :, ks:ke] += p.transpose(-1, -2) @ do
+                dp = do @ v.transpose(-1, -2)
+                ds = p * (dp - delta[:, :, qs:qe, None])
+                dq[:, :, qs:qe] += ds @ k
+                dk[:, :, ks:ke] += ds.transpose(-1, -2) @ q
+
+        return dq.to(qr.dtype), dk.to(kr.dtype), dv.to(vr.dtype), None, None
+
+def tiled_retention(qr, kr, vr, bias_fn, block_size=512):
+    return TiledRetention.apply(qr, kr, vr, bias_fn, block_size)
+
+def chunkwise_retention(qr, kr, vr, table, width, chunk_size):
+    '''
+    Retention by chunks of chunk_size azimuth columns (all rows): tokens are reordered chunk by
+    chunk and run through TiledRetention with one chunk per block, so scores are bounded by
+    (Hp * chunk_size)^2 per head in the forward and the backward pass and the output equals
+    the parallel retention.
+
+    * table: CiR table (heads, Hp, Wp // 2 + 1), see network/cir.py
+    * width: number of columns Wp of the patched image
+    '''
+    seq_len = qr.size(2)
+    height = seq_len // width
+    rows = torch.arange(height, device=qr.device)[:, None] * width
+    # patch index of each token in chunk order, and its inverse
+    order = torch.cat([(rows + torch.arange(start, min(start + chunk_size, width), device=qr.device)).flatten()
+                       for start in range(0, width, chunk_size)])
+    inverse = torch.argsort(order)
+
+    bias_fn = lambda q_idx, k_idx: cir_gather(table, width, order[q_idx], order[k_idx])
+    output = tiled_retention(qr[:, :, order], kr[:, :, order], vr[:, :, order], bias_fn, height * chunk_size)
+    return output[:, :, inverse]
+
+def axial_retention(qr, kr, vr, table, img_dim):
+    '''
+    Retention decomposed in two passes on the (Hp, Wp) grid: first along the azimuth
+    (tokens of the same row, circular decay), then along the rows (tokens of the same
+    column). Scores are O(Hp * Wp * (Hp + Wp)) instead of O((Hp * Wp)^2).
+
+    * table: CiR table (heads, Hp, Wp // 2 + 1), see network/cir.py
+    '''
+    bsz, heads, _, key_dim = qr.size()
+    height, width = img_dim
+    q = qr.view(bsz, heads, height, width, key_dim)
+    k = kr.view(bsz, heads, height, width, key_dim)
+    v = vr.view(bsz, heads, height, width, vr.size(-1))
+
+    rows = torch.arange(height, device=qr.device)
+    cols = torch.arange(width, device=qr.device)
+    row_diff = torch.abs(rows[:, None] - rows)
+    col_diff = torch.abs(cols[:, None] - cols)
+    col_diff = torch.minimum(col_diff, width - col_diff)  # circular distance
+
+    # azimuth pass, (bsz, heads, Hp, Wp, Wp) scores
+    qk_mat = q @ k.transpose(-1, -2) + table[:, 0, col_diff][:, None]
+    v = torch.softmax(qk_mat, dim=-1) @ v
+
+    # row pass, (bsz, heads, Wp, Hp, Hp) scores
+    qk_mat = q.transpose(2, 3) @ k.permute(0, 1, 3, 4, 2) + table[:, row_diff, 0][:, None]
+    output = torch.softmax(qk_mat, dim=-1) @ v.transpose(2, 3)
+
+    return output.transpose(2, 3).reshape(bsz, heads, height * width, -1)
+
+def window_retention(qr, kr, vr, table, width, radius, window_size):
+    '''
+    Retention restricted to a circular neighborhood along the azimuth: the queries of
+    window_size consecutive columns attend to the keys of the same columns plus radius
+    columns on each side (wrapping around the seam), on all rows. Keys farther than
+    radius columns have a CiR bias below the cutoff the radius was derived from.
+
+    * table: CiR table of the heads in qr (heads, Hp, Wp // 2 + 1)
+    * width: number of columns Wp of the patched image
+    '''
+    bsz, heads, seq_len, key_dim = qr.size()
+    value_dim = vr.size(-1)
+    height = seq_len // width
+    num_windows = math.ceil(width / window_size)
+    span = window_size + 2 * radius
+    assert span < width, "window span covers the whole azimuth, use dense retention"
+
+    # query columns (the last window wraps and its extra outputs are dropped)
+    q_cols = torch.arange(num_windows * window_size, device=qr.device) % width
+    # key columns of each window, (num_windows, span)
+    k_cols = torch.arange(num_windows, device=qr.device)[:, None] * window_size - radius
+    k_cols = (k_cols + torch.arange(span, device=qr.device)) % width
+
+    def windows(x, cols, size):
+        x = x.reshape(bsz, heads, height, width, x.size(-1))[:, :, :, cols.flatten()]
+        x = x.view(bsz, heads, height, num_windows, size, x.size(-1)).transpose(2, 3)
+        return x.reshape(bsz, heads, num_windows, height * size, x.size(-1))
+
+    q = windows(qr, q_cols, window_size)
+    k = windows(kr, k_cols, span)
+    v = windows(vr, k_cols, span)
+
+    # circular translation invariance: the bias is the same for every window
+    rows = torch.arange(height, device=qr.device)[:, None] * width
+    bias = cir_gather(table, width, (rows + q_cols[:window_size]).flatten(), (rows + k_cols[0]).flatten())
+
+    qk_mat = q @ k.transpose(-1, -2) + bias[:, None]
+    output = torch.softmax(qk_mat, dim=-1) @ v   # bsz, heads, num_windows, Hp * window_size, head_size
+
+    output = output.view(bsz, heads, num_windows, height, window_size, value_dim).transpose(2, 3)
+    output = output.reshape(bsz, heads, height, num_windows * window_size, value_dim)[:, :, :, :width]
+    return output.reshape(bsz, heads, seq_len, value_dim)
+
+def linear_retention(qr, kr, vr, eigval, feat, eps=1e-6):
+    '''
+    Kernelized retention in O(seq_len * rank * key_dim * head_size): exp(q.k + bias) is
+    replaced by phi(q).phi(k) * exp(bias), with phi(x) = elu(x) + 1 and exp(bias) given
+    by its low rank factorization (network/cir.py cir_features). Keys and values are
+    summarized once per rank component instead of scoring every pair of tokens.
+    The truncated kernel is not positive everywhere, a normalizer below eps (outputs
+    blown up or sign flipped) fails instead of being clamped, outside of graph export.
+
+    * eigval: (heads, rank), feat: (heads, seq_len, rank)
+    '''
+    bsz, heads, seq_len, key_dim = qr.size()
+    phi_q = F.elu(qr.float()) + 1
+    phi_k = F.elu(kr.float()) + 1
+    feat = feat.float()
+
+    # key side: (bsz, heads, seq_len, rank * key_dim)
+    k_feat = (feat[None, :, :, :, None] * phi_k[:, :, :, None, :]).flatten(3)
+    kv = k_feat.transpose(-1, -2) @ vr.float()    # bsz, heads, rank * key_dim, head_size
+    k_sum = k_feat.sum(dim=2)                     # bsz, heads, rank * key_dim
+
+    # query side
+    q_feat = ((feat * eigval.float()[:, None])[None, :, :, :, None] * phi_q[:, :, :, None, :]).flatten(3)
+    output = q_feat @ kv
+    normalizer = q_feat @ k_sum[..., None]
+    if not torch.jit.is_tracing() and not torch._dynamo.is_compiling():
+        assert (normalizer >= eps).all(), 'linear retention normalizer is not positive, increase linear_rank'
+
+    return (output / normalizer.clamp(min=eps)).to(vr.dtype)
+
+def fft_retention(qr, kr, vr, spectrum, img_dim):
+    '''
+    Decay (non-softmax) retention ((QK^T * D) V with the CiR kernel D = exp(bias), rows
+    scaled by 1 / sqrt(sum D) and normalized by the absolute score sum as in RetNet)
+    in O(seq_len log seq_len) per head and feature pair: D is translation invariant on
+    the patched image, so D @ x is a convolution applied by FFT (see cir_spectrum).
+
+    * spectrum: (heads, 2 * Hp, Wp // 2 + 1) from cir_spectrum
+    * img_dim: shape of the patched image (Hp, Wp)
+    '''
+    bsz, heads, seq_len, key_dim = qr.size()
+    height, width = img_dim
+
+    def conv(x):
+        # x: (..., heads, channels, seq_len) -> D @ x along seq_len
+        x = x.reshape(*x.shape[:-1], height, width)
+        x = torch.fft.rfft2(x, s=(2 * height, width))
+        x = torch.fft.irfft2(x * spectrum[:, None], s=(2 * height, width))
+        return x[..., :height, :].flatten(-2)
+
+    dtype = vr.dtype
+    qr, kr, vr = qr.float(), kr.float(), vr.float()
+    scale = conv(qr.new_ones(heads, 1, seq_len)).squeeze(1).rsqrt()   # heads, seq_len
+
+    # sum_j D_ij (q_i . k_j) v_j = sum_a q_ia (D @ (k_a v))_i
+    kv = kr.transpose(-1, -2)[:, :, :, None] * vr.transpose(-1, -2)[:, :, None]   # bsz, heads, key_dim, head_size, seq_len
+    kv = conv(kv.flatten(2, 3)).view(bsz, heads, key_dim, vr.size(-1), seq_len)
+    output = torch.einsum('bhnd,bhden->bhne', qr, kv)
+
+    normalizer = (qr * conv(kr.transpose(-1, -2)).transpose(-1, -2)).sum(dim=-1) * scale
+    normalizer = normalizer.detach().abs().clamp(min=1)
+
+    return (output * (scale / normalizer)[..., None]).to(dtype)
@@ -1,8 +1,13 @@
+import os
 import math
+from collections import OrderedDict
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from network.msr import MultiScaleRetention
+from network.cir import cir_table
+from network.merge import MergedTokens, bipartite_merge
 
 from timm.layers import DropPath, trunc_normal_
 
@@ -34,9 +39,46 @@ class Mlp(nn.Module):
             if m.bias is not None:
                 m.bias.data.zero_()
 
-    def forward(self, x, H, W):
+    def forward(self, x, H, W, index=None, merged=None):
+        '''
+        index: positions on the (H, W) grid of the tokens in x when only a subset of them
+        is kept, the depthwise conv sees zeros at the missing ones
+        merged: MergedTokens when x are merged tokens, the depthwise conv runs on their patches
+        '''
         x = self.fc1(x)
-        x = self.dwconv(x, H, W)
+        if index is not None:
+            grid = x.new_zeros(x.size(0), H * W, x.size(-1))
+            grid[:, index] = x
+            x = self.dwconv(grid, H, W)[:, index]
+        elif merged is not None:
+            x = merged.merge(self.dwconv(merged.unmerge(x), H, W))
+        else:
+            x = self.dwconv(x, H, W)
+        x = self.act(x)
+        x = self.drop(x)
+        x = self.fc2(x)
+        x = self.drop(x)
+        return x
+
+    def forward_stream(self, x, cols, img_dim, incremental_state):
+        '''
+        x: tokens of the azimuth columns cols = (start, end) of the (Hp, Wp) grid.
+        The fc1 output of the whole grid is kept in incremental_state, the depthwise
+        conv takes its left/right neighbor columns from there
+        '''
+        B, N, _ = x.shape
+        start, end = cols
+        x = self.fc1(x)
+
+        if "ffn" not in incremental_state:
+            incremental_state["ffn"] = x.new_zeros(B, x.size(-1), img_dim[0], img_dim[1])
+        ring = incremental_state["ffn"]
+        ring[:, :, :, start:end] = x.transpose(1, 2).reshape(B, -1, img_dim[0], end - start)
+
+        lo, hi = max(start - 1, 0), min(end + 1, img_dim[1])
+        x = self.dwconv.dwconv(ring[:, :, :, lo:hi])[:, :, :, start - lo:end - lo]
+        x = x.flatten(2).transpose(1, 2)
+
         x = self.act(x)
         x = self.drop(x)
         x = self.fc2(x)
@@ -76,8 +118,27 @@ class RetNet(nn.Module):
     * mlp_ratio: dimension of feed-forward network
     * heads: number of heads
     * img_dim: shape of input image
+    * retention_backend: dense, tiled (online softmax by blocks of block_size tokens) or
+      window (azimuth neighborhoods of window_size columns where the CiR bias is above window_cutoff)
+      or linear (kernelized, rank linear_rank factorization of the CiR kernel)
+      or fft (decay retention by FFT convolutions, O(N log N))
+    * rel_pos_cache: optional directory where relative position tensors are cached on disk
+    * retention_type: full 2D retention, axial (azimuth + row passes, dense backend only) or decay (no softmax)
+    * merge_ratio: optional fraction of the tokens merged after each layer (token merging, dense
+      full retention only, not with token pruning), tokens are unmerged at the output
+    * score_sharing: optional groups of layers (lists of indices) sharing the retention score map
+      of their first layer, the others only compute V (dense full retention only, no token merging
+      from the first to the last layer of a group)
+    * gate: swish output gate in retention (checkpoints trained without it have no gate weights)
+    * shape_cache_mb: memory cap of the relative position tensors kept for input shapes other than
+      img_dim (least recently used shapes are dropped first)
+    * kept_heads: optional heads (indices out of heads) kept in each layer after head pruning,
+      the relative position tensors keep all the heads and each layer selects its decays
     '''
-    def __init__(self, layers, hidden_dim, mlp_ratio, heads, img_dim, double_v_dim=True, drop_path_rate=0.0, activate_recurrent=False):
+    def __init__(self, layers, hidden_dim, mlp_ratio, heads, img_dim, double_v_dim=True, drop_path_rate=0.0, activate_recurrent=False,
+                 retention_backend='dense', block_size=512, rel_pos_cache=None, retention_type='full',
+                 window_size=32, window_cutoff=-20.0, linear_rank=64, merge_ratio=None, score_sharing=None,
+                 gate=False, shape_cache_mb=256, kept_heads=None):
         super(RetNet, self).__init__()
         self.layers = layers
         self.hidden_dim = hidden_dim
@@ -86,13 +147,44 @@ class RetNet(nn.Module):
         self.img_dim = img_dim
         self.slen = img_dim[0] * img_dim[1]
         self.activate_recurrent = activate_recurrent
+        self.retention_backend = retention_backend
+        self.merge_ratio = list(merge_ratio or []) + [0] * (layers - len(merge_ratio or []))
+        assert not any(self.merge_ratio) or (retention_backend == 'dense' and retention_type == 'full'), \
+            'token merging needs dense full retention'
+        # group of each layer sharing retention scores (None if not shared)
+        self.share_group = [None] * layers
+        for g, group in enumerate(score_sharing or []):
+            group = sorted(group)
+            assert all(self.share_group[i] is None for i in group), 'layers can belong to one sharing group only'
+            # merging after any layer from the first to the last of the group, in the group or not
+            assert not any(self.merge_ratio[i] for i in range(group[0], group[-1])), 'tokens can not be merged inside a sharing group'
+            for i in group:
+                self.share_group[i] = g
+        assert all(g is None for g in self.share_group) or (retention_backend == 'dense' and retention_type == 'full'), \
+            'score sharing needs dense full retention'
+        self.kept_heads = kept_heads or [None] * layers
+        assert len(self.kept_heads) == layers, 'kept_heads needs the heads of every layer'
+        for group in score_sharing or []:
+            assert len(set(str(self.kept_heads[i]) for i in group)) == 1, 'layers sharing scores must keep the same heads'
         self.gammas = (1 - torch.exp(torch.linspace(math.log(1/32), math.log(1/512), heads))).detach().cpu().tolist()
         #self.D = [self._get_D(img_dim[0] * img_dim[1], g).cuda() for g in self.gammas]
-        self.retnet_rel_pos = self.get_rel_pos(self.activate_recurrent, manhattan=True)
+
+        # relative position buffers of img_dim (not saved), they follow .to(device/dtype) and .half()
+        self.manhattan = True
+        self.rel_pos_cache = rel_pos_cache
+        # reported once here, the tensors of other input shapes are built silently
+        print('Using {} relative position encoding'.format('recurrent' if activate_recurrent else 'Manhattan' if self.manhattan else 'Euclidean'))
+        (sin, cos), mask = self.load_rel_pos(self.img_dim)
+        self.register_buffer('rel_sin', sin, persistent=False)
+        self.register_buffer('rel_cos', cos, persistent=False)
+        self.register_buffer('rel_mask', mask, persistent=False)
+        self.shape_cache = OrderedDict()
+        self.shape_cache_mb = shape_cache_mb
 
         self.retentions = nn.ModuleList([
-            MultiScaleRetention(self.hidden_dim, self.heads, double_v_dim, self.slen)
-            for _ in range(layers)
+            MultiScaleRetention(self.hidden_dim, self.heads, double_v_dim, self.slen, retention_backend, block_size, retention_type,
+                                window_size, window_cutoff, linear_rank, gate, self.kept_heads[i])
+            for i in range(layers)
         ])
         self.ffns = nn.ModuleList([
             Mlp(self.hidden_dim, self.mlp_dim, self.hidden_dim)
@@ -129,64 +221,122 @@ class RetNet(nn.Module):
 
         return D
 
-    def get_rel_pos(self, activate_recurrent=False, manhattan=True):
-        angle = 1.0 / (10000 ** torch.linspace(0, 1, self.hidden_dim // self.heads // 2)).cuda()
-        angle = angle.unsqueeze(-1).repeat(1, 2).flatten()
-        decay = torch.log(1 - 2 ** (-5 - torch.arange(self.heads, dtype=torch.float))).cuda()
+    @property
+    def retnet_rel_pos(self):
+        return ((self.rel_sin, self.rel_cos), self.rel_mask)
+
+    def load_rel_pos(self, img_dim, device=None):
+        '''
+        Relative position tensors of the patched image img_dim, from the disk cache if enabled
+        '''
+        if self.activate_recurrent:
+            encoding = 'recurrent'
+        else:
+            encoding = 'manhattan' if self.manhattan else 'euclidean'
+
+        cache_file = None
+        if self.rel_pos_cache is not None:
+            cache_file = os.path.join(self.rel_pos_cache,
+                                      f'rel_pos_{encoding}_{img_dim[0]}x{img_dim[1]}_h{self.heads}_d{self.hidden_dim // self.heads}.pt')
+
+        if cache_file is not None and os.path.isfile(cache_file):
+            (sin, cos), mask = torch.load(cache_file, map_location=device)
+        else:
+            (sin, cos), mask = self.get_rel_pos(self.activate_recurrent, self.manhattan, device=device, img_dim=img_dim)
+            if cache_file is not None:
+                os.makedirs(self.rel_pos_cache, exist_ok=True)
+                torch.save(((sin.cpu(), cos.cpu()), mask.cpu()), cache_file)
+
+        return (sin, cos), mask
+
+    def _apply(self, fn, *args, **kwargs):
+        # the tables cached for other shapes follow the buffers, rebuild them after a move or a cast
+        self.shape_cache.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def get_shape_rel_pos(self, img_dim, device):
+        '''
+        Relative position of the patched image img_dim: the buffers for the img_dim of the model,
+        an LRU cache capped at shape_cache_mb for the other shapes
+        '''
+        if tuple(img_dim) == tuple(self.img_dim):
+            return self.retnet_rel_pos
+
+        key = (tuple(img_dim), device, self.rel_sin.dtype, self.rel_cos.dtype, self.rel_mask.dtype)
+        if key in self.shape_cache:
+            self.shape_cache.move_to_end(key)
+            return self.shape_cache[key]
+
+        (sin, cos), mask = self.load_rel_pos(img_dim, device)
+        # follow the dtype of the buffers
+        sin, cos, mask = sin.to(self.rel_sin.dtype), cos.to(self.rel_cos.dtype), mask.to(self.rel_mask.dtype)
+        rel_pos = ((sin, cos), mask)
+
+        size = lambda rel_pos: sum(t.numel() * t.element_size() for t in (*rel_pos[0], rel_pos[1])) / 2**20
+        if size(rel_pos) <= self.shape_cache_mb:
+            while sum(size(cached) for cached in self.shape_cache.values()) + size(rel_pos) > self.shape_cache_mb:
+                self.shape_cache.popitem(last=False)
+            self.shape_cache[key] = rel_pos
+        return rel_pos
+
+    def get_angle(self, device=None):
+        angle = 1.0 / (10000 ** torch.linspace(0, 1, self.hidden_dim // self.heads // 2, device=device))
+        return angle.unsqueeze(-1).repeat(1, 2).flatten()
+
+    def get_rel_pos(self, activate_recurrent=False, manhattan=True, device=None, img_dim=None):
+        img_dim = img_dim or self.img_dim
+        slen = img_dim[0] * img_dim[1]
+        angle = self.get_angle(device)
+        decay = torch.log(1 - 2 ** (-5 - torch.arange(self.heads, dtype=torch.float, device=device)))
         # alternative decay described in the paper
-        #gammas = (1 - torch.exp(torch.linspace(math.log(1/32), math.log(1/512), self.heads))).cuda()
+        #gammas = (1 - torch.exp(torch.linspace(math.log(1/32), math.log(1/512), self.heads)))
 
 
         if activate_recurrent:
-            print('Using recurrent relative position encoding')
-            sin = torch.sin(angle * (self.slen - 1))
-            cos = torch.cos(angle * (self.slen - 1))
+            sin = torch.sin(angle * (slen - 1))
+            cos = torch.cos(angle * (slen - 1))
             retention_rel_pos = ((sin, cos), decay.exp())
         elif manhattan:
-            print('Using Manhattan relative position encoding')
-            index = torch.arange(self.slen).to(decay)
+            index = torch.arange(slen).to(decay)
             sin = torch.sin(index[:, None] * angle[None, :])
             cos = torch.cos(index[:, None] * angle[None, :])
-            rows = torch.arange(self.slen).to(decay) // self.img_dim[1]
-            cols = torch.arange(self.slen).to(decay) % self.img_dim[1]
-            row_diff = torch.abs(rows[:, None] - rows)
-            col_diff = torch.abs(cols[:, None] - cols)
-            col_diff = torch.minimum(col_diff, self.img_dim[1] - col_diff)  # circular distance
-            mask = row_diff + col_diff
-            # exponential mapping
-            mask = (mask / mask.max())** 2 * (self.slen - 1)
-            # mask = ((mask - 1) / (self.img_dim[0] + self.img_dim[1] - 3))** 2 * (self.slen - 1) + 1
-            mask.fill_diagonal_(0)
-            # for softmax
-            mask = mask * decay[:, None, None]
-            #comment next two lines for softmax
-            # mask = torch.exp(mask * decay[:, None, None])
-            # mask = mask / mask.sum(dim=-1, keepdim=True).sqrt()
+            # CiR bias only depends on (row diff, circular col diff), stored as a
+            # (heads, Hp, Wp // 2 + 1) table and expanded inside MultiScaleRetention
+            mask = cir_table(decay, img_dim)
             retention_rel_pos = ((sin, cos), mask)
         else:
-            print('Using Euclidean relative position encoding')
-            index = torch.arange(self.slen).to(decay)
+            index = torch.arange(slen).to(decay)
             sin = torch.sin(index[:, None] * angle[None, :])
             cos = torch.cos(index[:, None] * angle[None, :])
-            mask = torch.tril(torch.ones(self.slen, self.slen).to(decay))
+            mask = torch.tril(torch.ones(slen, slen).to(decay))
             mask = torch.masked_fill(index[:, None] - index[None, :], ~mask.bool(), float("inf"))
             mask = torch.exp(mask * decay[:, None, None])
             mask = torch.nan_to_num(mask)
             # create upper triangle
             mask = mask + mask.transpose(1, 2)
-            mask = mask - torch.eye(self.slen).to(decay)
+            mask = mask - torch.eye(slen).to(decay)
             # normalization
             mask = mask / mask.sum(dim=-1, keepdim=True).sqrt()
             retention_rel_pos = ((sin, cos), mask)
 
         return retention_rel_pos
 
-    def forward(self, x, incremental_state=None):
+    def forward(self, x, incremental_state=None, index=None, img_dim=None):
         """
         X: (batch_size, number of patches, number of features)
+        index: optional positions on the patched image of the tokens of X when only a subset of the
+        patches is kept (token pruning), X is then (batch_size, len(index), number of features)
+        img_dim: shape of the patched image if different from the one of the model
         """
+        assert index is None or not any(self.merge_ratio), 'token merging can not be used on pruned tokens'
+        img_dim = img_dim or self.img_dim
+        rel_pos = self.get_shape_rel_pos(img_dim, x.device)
 
         is_first_step = self.is_first_step(incremental_state)
+        merged = None
+        shared = {}
+        # dense CiR bias expanded by the first layer, reused by the others
+        bias_cache = {}
     
         for i in range(self.layers):
             if incremental_state is None or is_first_step:
@@ -197,10 +347,26 @@ class RetNet(nn.Module):
                 if i not in incremental_state:
                     incremental_state[i] = {}
 
-            y = self.drop_path[i](self.retentions[i](self.norms1[i](x), self.retnet_rel_pos, incremental_state)) + x
+            h = self.norms1[i](x)
+            group = self.share_group[i] if incremental_state is None else None
+            y = self.drop_path[i](self.retentions[i](h, rel_pos, incremental_state, index=index,
+                                                     shared=shared.setdefault(group, {}) if group is not None else None,
+                                                     bias_cache=bias_cache)) + x
             #y = self.retentions[i](self.norms1[i](x), self.D) + x
 
-            x = self.drop_path[i](self.ffns[i](self.norms2[i](y), self.img_dim[0], self.img_dim[1])) + y
+            x = self.drop_path[i](self.ffns[i](self.norms2[i](y), img_dim[0], img_dim[1], index, merged)) + y
+
+            if self.merge_ratio[i] > 0 and incremental_state is None:
+                if merged is None:
+                    (sin, cos), table = rel_pos
+                    merged = MergedTokens.identity(x.size(0), table, img_dim[1], sin, cos)
+                # match tokens on the keys of this layer
+                merged, merge = bipartite_merge(self.retentions[i].keys(h), merged, self.merge_ratio[i])
+                x = merge(x)
+                rel_pos = merged.rel_pos
+
+        if merged is not None:
+            x = merged.unmerge(x)
 
         # reshape to patched image shape
         # if incremental_state is None:
@@ -210,40 +376,152 @@ class RetNet(nn.Module):
 
     def forward_recurrent(self, x_n, s_n_1s, n):
         """
-        X: (batch_size, sequence_length, hidden_size)
-        s_n_1s: list of lists of tensors of shape (batch_size, hidden_size // heads, hidden_size // heads)
+        X: (batch_size, 1, hidden_size) token at position n
+        s_n_1s: list with the incremental state (dict) of each layer, updated in place
 
         """
+        assert self.activate_recurrent, "recurrent forward needs activate_recurrent=True"
+
+        angle = self.get_angle(x_n.device)
+        rel_pos = ((torch.sin(angle * n), torch.cos(angle * n)), self.rel_mask)
+
         s_ns = []
         for i in range(self.layers):
-            # list index out of range
-            o_n, s_n = self.retentions[i].forward_recurrent(self.norms1[i](x_n), s_n_1s[i], n)
+            o_n = self.retentions[i](self.norms1[i](x_n), rel_pos, s_n_1s[i])
             y_n = o_n + x_n
-            s_ns.append(s_n)
-            x_n = self.ffns[i](self.norms2[i](y_n)) + y_n
+            s_ns.append(s_n_1s[i])
+            # single token, the depthwise conv of the ffn only sees itself
+            x_n = self.ffns[i](self.norms2[i](y_n), 1, x_n.size(1)) + y_n
         
         return x_n, s_ns
     
-    def forward_chunkwise(self, x_i, r_i_1s, i):
+    def forward_chunkwise(self, x, chunk_size, img_dim=None):
         """
-        X: (batch_size, sequence_length, hidden_size)
-        r_i_1s: list of lists of tensors of shape (batch_size, hidden_size // heads, hidden_size // heads)
+        X: (batch_size, number of patches, number of features)
+        chunk_size: number of azimuth columns per chunk. Retention runs chunk by chunk
+        carrying the online softmax state, so its peak memory is bounded by the chunk size
+        img_dim: shape of the patched image if different from the one of the model
 
         """
-        r_is = []
-        for j in range(self.layers):
-            o_i, r_i = self.retentions[j].forward_chunkwise(self.norms1[j](x_i), r_i_1s[j], i)
-            y_i = o_i + x_i
-            r_is.append(r_i)
-            x_i = self.ffns[j](self.norms2[j](y_i)) + y_i
+        img_dim = img_dim or self.img_dim
+        rel_pos = self.get_shape_rel_pos(img_dim, x.device)
+
+        for i in range(self.layers):
+            y = self.drop_path[i](self.retentions[i](self.norms1[i](x), rel_pos, chunk_size=chunk_size)) + x
+            x = self.drop_path[i](self.ffns[i](self.norms2[i](y), img_dim[0], img_dim[1])) + y
         
-        return x_i, r_is
+        return x
+
+    def forward_stream(self, x, cols, incremental_state):
+        """
+        X: (batch_size, Hp * (end - start), hidden_size) tokens of the azimuth columns cols = (start, end)
+        incremental_state: dict with the ring buffers of each layer over the whole patched image,
+        updated in place. Columns not received yet in the current rotation contribute with
+        their values from the previous rotation (or are ignored before the first one), the
+        buffers of earlier columns are not recomputed: an approximation of forward unless
+        cols is the whole patched image
+
+        """
+        start, end = cols
+        rows = torch.arange(self.img_dim[0], device=x.device)[:, None] * self.img_dim[1]
+        idx = (rows + torch.arange(start, end, device=x.device)).flatten()
+
+        if "valid" not in incremental_state:
+            incremental_state["valid"] = torch.zeros(self.slen, dtype=torch.bool, device=x.device)
+        incremental_state["valid"][idx] = True
+
+        for i in range(self.layers):
+            if i not in incremental_state:
+                incremental_state[i] = {}
+
+            y = self.retentions[i].stream_forward(self.norms1[i](x), self.retnet_rel_pos, idx, incremental_state["valid"], incremental_state[i]) + x
+            x = self.ffns[i].forward_stream(self.norms2[i](y), cols, self.img_dim, incremental_state[i]) + y
+
+        return x
 
     def is_first_step(self, incremental_state):
         if incremental_state is None:
             return False
         return incremental_state.get("is_first_step", False)
 
+class PatchMerging(nn.Module):
+    '''
+    Merge stride = (rows, cols) neighboring tokens of the (Hp, Wp) grid with a strided conv.
+    The grid is padded to a multiple of the stride, circularly along the azimuth
+    '''
+    def __init__(self, in_dim, out_dim, img_dim, stride):
+        super(PatchMerging, self).__init__()
+        self.img_dim = img_dim
+        self.stride = stride
+        self.out_img_dim = self.get_out_img_dim(img_dim)
+        self.reduction = nn.Conv2d(in_dim, out_dim, kernel_size=stride, stride=stride)
+        self.norm = nn.LayerNorm(out_dim)
+
+    def get_out_img_dim(self, img_dim):
+        return (math.ceil(img_dim[0] / self.stride[0]), math.ceil(img_dim[1] / self.stride[1]))
+
+    def forward(self, x, img_dim=None):
+        img_dim = img_dim or self.img_dim
+        out_img_dim = self.get_out_img_dim(img_dim)
+        B, N, C = x.shape
+        x = x.transpose(1, 2).reshape(B, C, *img_dim)
+        pad_w = out_img_dim[1] * self.stride[1] - img_dim[1]
+        pad_h = out_img_dim[0] * self.stride[0] - img_dim[0]
+        x = torch.cat([x, x[..., :pad_w]], dim=-1)
+        x = F.pad(x, (0, 0, 0, pad_h))
+        x = self.reduction(x).flatten(2).transpose(1, 2)
+        return self.norm(x)
+
+class HierarchicalRetNet(nn.Module):
+    '''
+    Multi-stage RetNet: a RetNet per stage, with its own CiR bias for its grid, and
+    PatchMerging between stages to reduce the grid
+
+    * depths: number of blocks per stage
+    * dims: hidden dimension per stage (the first one is the input one)
+    * heads: number of heads per stage
+    * downsample: (rows, cols) tokens merged before each stage after the first one
+    * img_dim: shape of the patched image of the first stage
+    * kwargs: RetNet options shared by all stages
+
+    returns the list of the (B, N_i, dims[i]) features of each stage
+    '''
+    def __init__(self, depths, dims, heads, downsample, mlp_ratio, img_dim, double_v_dim=True, drop_path_rate=0.0, **kwargs):
+        super(HierarchicalRetNet, self).__init__()
+        assert len(depths) == len(dims) == len(heads) == len(downsample) + 1, 'one depth, dim and heads per stage, one downsample between stages'
+        self.dims = dims
+        self.img_dims = [tuple(img_dim)]
+        self.merges = nn.ModuleList()
+        for i, stride in enumerate(downsample):
+            self.merges.append(PatchMerging(dims[i], dims[i + 1], self.img_dims[-1], tuple(stride)))
+            self.img_dims.append(self.merges[-1].out_img_dim)
+
+        self.stages = nn.ModuleList([
+            RetNet(depths[i], dims[i], mlp_ratio, heads[i], self.img_dims[i], double_v_dim, drop_path_rate, **kwargs)
+            for i in range(len(depths))
+        ])
+
+    def get_img_dims(self, img_dim=None):
+        '''
+        Patched image of each stage for a first stage patched image img_dim
+        '''
+        if img_dim is None:
+            return self.img_dims
+        img_dims = [tuple(img_dim)]
+        for merge in self.merges:
+            img_dims.append(merge.get_out_img_dim(img_dims[-1]))
+        return img_dims
+
+    def forward(self, x, img_dim=None):
+        img_dims = self.get_img_dims(img_dim)
+        features = []
+        for i, stage in enumerate(self.stages):
+            if i > 0:
+                x = self.merges[i - 1](x, img_dims[i - 1])
+            x = stage(x, img_dim=img_dims[i])
+            features.append(x)
+        return features
+
 class DWConv(nn.Module):
     def __init__(self, dim=128):
         super(DWConv, self).__init__()
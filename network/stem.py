@@ -12,9 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.ao.nn.quantized import FloatFunctional
+
+from network.fuse import fold_after, fold_through_leaky_relu
 
 class ConvStem(nn.Module):
     def __init__(self,
@@ -45,6 +47,15 @@ class ConvStem(nn.Module):
         x = self.conv_block(x) # B, hidden_dim, image_size[0], image_size[1]
         return x
 
+    def fuse_for_inference(self):
+        '''
+        Folds the BatchNorms that can be folded exactly (see network/fuse.py), the input of
+        a ResContextBlock only feeds its 1x1 conv1
+        '''
+        blocks = list(self.conv_block)
+        for block, next_block in zip(blocks, blocks[1:] + [None]):
+            block.fuse_for_inference(next_block.conv1 if isinstance(next_block, ResContextBlock) else None)
+
 
 class ResContextBlock(nn.Module):
     # From T. Cortinhal et al.
@@ -62,6 +73,9 @@ class ResContextBlock(nn.Module):
         self.act3 = nn.LeakyReLU()
         self.bn2 = nn.BatchNorm2d(out_filters)
 
+        # residual add (quantized add once the stem is quantized)
+        self.skip = FloatFunctional()
+
     def forward(self, x):
         shortcut = self.conv1(x)
         shortcut = self.act1(shortcut)
@@ -74,9 +88,19 @@ class ResContextBlock(nn.Module):
         resA = self.act3(resA)
         resA2 = self.bn2(resA)
 
-        output = shortcut + resA2
+        output = self.skip.add(shortcut, resA2)
         return output
 
+    def fuse_for_inference(self, next_conv=None):
+        '''
+        Folds bn2 in conv3 (scale) and in next_conv, the 1x1 conv the output feeds (shift), bn1
+        feeds the padded conv3 and stays. The LeakyReLUs run in place on the conv outputs
+        '''
+        if next_conv is not None and fold_through_leaky_relu(self.conv3, self.bn2, next_conv):
+            self.bn2 = nn.Identity()
+        for act in (self.act1, self.act2, self.act3):
+            act.inplace = True
+
 
 class ResBlock(nn.Module):
     # From T. Cortinhal et al.
@@ -105,6 +129,10 @@ class ResBlock(nn.Module):
         self.act5 = nn.LeakyReLU()
         self.bn4 = nn.BatchNorm2d(out_filters)
 
+        # concat and residual add (quantized once the stem is quantized)
+        self.cat = FloatFunctional()
+        self.skip = FloatFunctional()
+
         if pooling:
             self.dropout = nn.Dropout2d(p=dropout_rate)
             self.pool = nn.AvgPool2d(kernel_size=kernel_size, stride=2, padding=1)
@@ -127,11 +155,11 @@ class ResBlock(nn.Module):
         resA = self.act4(resA)
         resA3 = self.bn3(resA)
 
-        concat = torch.cat((resA1, resA2, resA3), dim=1)
+        concat = self.cat.cat((resA1, resA2, resA3), dim=1)
         resA = self.conv5(concat)
         resA = self.act5(resA)
         resA = self.bn4(resA)
-        resA = shortcut + resA
+        resA = self.skip.add(shortcut, resA)
 
         if self.pooling:
             if self.drop_out:
@@ -146,4 +174,15 @@ class ResBlock(nn.Module):
                 resB = self.dropout(resA)
             else:
                 resB = resA
-            return resB
\ No newline at end of file
+            return resB
+
+    def fuse_for_inference(self, next_conv=None):
+        '''
+        Folds bn3 in the input channels of the 1x1 conv5 it feeds through the concatenation, bn1
+        and bn2 also feed padded convs and bn4 the output. The LeakyReLUs run in place on the conv outputs
+        '''
+        channels = self.conv5.in_channels // 3
+        fold_after(self.bn3, self.conv5, slice(2 * channels, 3 * channels))
+        self.bn3 = nn.Identity()
+        for act in (self.act1, self.act2, self.act3, self.act4, self.act5):
+            act.inplace = True
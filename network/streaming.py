@@ -0,0 +1,165 @@
+# Azimuth streaming inference of RangeRet for spinning LiDARs
+
+import time
+import torch
+import torch.nn.functional as F
+
+from network.retnet import RetNet
+from network.rangeret import SemanticHead
+
+# receptive field (in columns) of ConvStem on each side: 3 ResContextBlock (1 + 2) and ResBlock (1 + 2 + 1)
+STEM_HALO = 13
+
+class StreamingRangeRet(object):
+    '''
+    Run a RangeRet model on azimuth slices of the range image as they arrive.
+
+    Every slice goes through ConvStem (with a halo of STEM_HALO columns), the patch
+    embedding of the tokens it completes and the RetNet layers, which keep ring buffers
+    of keys/values and ffn features over the whole patched image (RetNet.forward_stream).
+    Columns not received yet in the current rotation contribute with their values of the
+    previous rotation (they are ignored during the first one). Labels of a pixel column
+    come out as soon as the tokens of its bilinear upsampling are computed, i.e. a few
+    columns after it was received.
+
+    This is an approximation of the full frame forward: retention is global along the
+    azimuth, and keys/values (and ffn features) of a column are not recomputed when later
+    columns arrive. Only a slice of the whole scan is exact. Narrower slices lose more,
+    streaming the same scan again only converges over several rotations (about one per
+    layer); benchmark.py --stream reports the loss per slice width.
+
+    * model: RangeRet with RetNet backbone and SemanticHead, in eval mode
+    * lookahead: columns the stem waits for on its right side (up to STEM_HALO) before a
+      column is final, trades latency for not using stale data from the previous rotation
+    '''
+    def __init__(self, model, lookahead=0):
+        assert isinstance(model.backbone, RetNet), 'streaming inference needs the RetNet backbone'
+        assert isinstance(model.head, SemanticHead), 'streaming inference needs the SemanticHead'
+        # forward_stream scores the tokens against dense key/value buffers with the softmax of full retention
+        retention = model.backbone.retentions[0]
+        assert retention.retention_type == 'full' and retention.backend in ('dense', 'tiled', 'window'), \
+            'streaming inference needs full retention with the dense, tiled or window backend'
+        assert not any(model.backbone.merge_ratio) and all(g is None for g in model.backbone.share_group), \
+            'streaming inference does not support token merging or score sharing'
+        assert not model.token_pruning, 'streaming inference does not support token pruning'
+
+        self.model = model
+        self.H, self.W = model.H, model.W
+        self.Hp, self.Wp = model.patched_image
+        self.patch = model.patch_size[1]
+        self.stride = model.stride[1]
+        self.lookahead = lookahead
+
+        # horizontal weights of the bilinear upsampling of SemanticHead (align_corners=False)
+        src = ((torch.arange(self.W, dtype=torch.float) + 0.5) * self.Wp / self.W - 0.5).clamp(min=0)
+        self.i0 = src.floor().long()
+        self.i1 = (self.i0 + 1).clamp(max=self.Wp - 1)
+        self.w1 = src - self.i0
+
+        self.reset()
+
+    def reset(self):
+        '''
+        Drop every buffer, the next slice starts a new sequence at azimuth column 0
+        '''
+        self.state = {}
+        self.raw = None         # (B, C_in, H, W) range image of the last rotation
+        self.stem = None        # (B, C, H, W) ConvStem output
+        self.features = None    # (B, C, Hp, Wp) RetNet output
+        self.received = 0
+        self.stem_done = 0
+        self.tokens_done = 0
+        self.pixels_done = 0
+
+    @torch.no_grad()
+    def push(self, columns):
+        '''
+        columns: (B, C_in, H, n) next n azimuth columns of the range image
+
+        returns a list of (first column, logits (B, H, m, num_classes)) with the pixel
+        columns finalized by this slice (two entries if the slice ends a rotation)
+        '''
+        outputs = []
+        while columns.size(-1) > 0:
+            n = min(columns.size(-1), self.W - self.received)
+            if self.raw is None:
+                self.raw = columns.new_zeros(columns.size(0), columns.size(1), self.H, self.W)
+            self.raw[..., self.received:self.received + n] = columns[..., :n]
+            self.received += n
+            columns = columns[..., n:]
+
+            output = self.advance()
+            if output is not None:
+                outputs.append(output)
+
+            if self.received == self.W:
+                # rotation completed, the buffers become the previous rotation
+                self.received = 0
+                self.stem_done = 0
+                self.tokens_done = 0
+                self.pixels_done = 0
+
+        return outputs
+
+    def advance(self):
+        model = self.model
+
+        # stem columns with enough context on the right
+        stem_end = self.W if self.received == self.W else max(self.received - self.lookahead, 0)
+        if stem_end > self.stem_done:
+            lo = max(self.stem_done - STEM_HALO, 0)
+            hi = min(stem_end + STEM_HALO, self.W)
+            x = model.rem(self.raw[..., lo:hi])
+            if self.stem is None:
+                self.stem = x.new_zeros(x.size(0), x.size(1), self.H, self.W)
+            self.stem[..., self.stem_done:stem_end] = x[..., self.stem_done - lo:stem_end - lo]
+            self.stem_done = stem_end
+
+        # tokens whose patch is covered by final stem columns
+        tokens_end = 0 if self.stem_done < self.patch else min((self.stem_done - self.patch) // self.stride + 1, self.Wp)
+        if tokens_end > self.tokens_done:
+            start, end = self.tokens_done, tokens_end
+            x = model.viembed.proj(self.stem[..., self.stride * start:self.stride * (end - 1) + self.patch])
+            x = model.viembed.norm(x.flatten(2).transpose(1, 2))
+            x = model.backbone.forward_stream(x, (start, end), self.state)
+            if self.features is None:
+                self.features = x.new_zeros(x.size(0), x.size(-1), self.Hp, self.Wp)
+            self.features[..., start:end] = x.transpose(1, 2).reshape(x.size(0), -1, self.Hp, end - start)
+            self.tokens_done = tokens_end
+
+        # pixel columns whose upsampling only needs computed tokens
+        if self.tokens_done == self.Wp:
+            pixels_end = self.stem_done
+        else:
+            pixels_end = min(int((self.i1 < self.tokens_done).sum()), self.stem_done)
+        if pixels_end <= self.pixels_done:
+            return None
+
+        start, end = self.pixels_done, pixels_end
+        i0, i1, w1 = self.i0[start:end], self.i1[start:end], self.w1[start:end].to(self.features)
+        t0, t1 = int(i0[0]), int(i1[-1]) + 1
+
+        # bilinear upsampling: rows with interpolate (columns unchanged), then columns
+        x = F.interpolate(self.features[..., t0:t1], size=(self.H, t1 - t0), mode='bilinear')
+        x = x[..., i0 - t0] * (1 - w1) + x[..., i1 - t0] * w1
+        x = x + self.stem[..., start:end]
+        logits = model.head.project(x)
+
+        self.pixels_done = pixels_end
+        return start, logits
+
+    def __call__(self, scan, slice_width):
+        '''
+        Stream a full scan (B, C_in, H, W) by slices of slice_width columns and return the
+        logits (B, H, W, num_classes) and the latency (s) from the last slice to its labels
+        '''
+        logits = None
+        for start in range(0, self.W, slice_width):
+            begin = time.time()
+            for first, output in self.push(scan[..., start:start + slice_width]):
+                if logits is None:
+                    logits = output.new_zeros(output.size(0), self.H, self.W, output.size(-1))
+                logits[:, :, first:first + output.size(2)] = output
+        if scan.is_cuda:
+            torch.cuda.synchronize()
+        return logits, time.time() - begin
@@ -41,9 +41,10 @@ class VisionEmbedding(nn.Module):
 
     def forward(self, x, masked_position=None, **kwargs):
         B, C, H, W = x.shape
+        # any image size, the number of patches follows the input
         assert (
-            H == self.img_size[0] and W == self.img_size[1]
-        ), f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+            H >= self.patch_size[0] and W >= self.patch_size[1]
+        ), f"Input image size ({H}*{W}) is smaller than the patch size ({self.patch_size[0]}*{self.patch_size[1]})."
         x = self.proj(x).flatten(2).transpose(1, 2)
         x = self.norm(x)
 
@@ -1,6 +1,7 @@
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from timm.layers import DropPath, trunc_normal_
 
@@ -59,9 +60,10 @@ class Attention(nn.Module):
         self.proj = nn.Linear(dim, dim, bias=False)
         self.proj_drop = nn.Dropout(proj_drop)
 
-        self.sr_ratio = sr_ratio
-        if sr_ratio > 1:
-            self.sr = nn.Conv2d(dim, dim, kernel_size=sr_ratio, stride=sr_ratio)
+        # spatial reduction of keys/values, int or (rows, cols)
+        self.sr_ratio = tuple(sr_ratio) if isinstance(sr_ratio, (list, tuple)) else (sr_ratio, sr_ratio)
+        if max(self.sr_ratio) > 1:
+            self.sr = nn.Conv2d(dim, dim, kernel_size=self.sr_ratio, stride=self.sr_ratio)
             self.norm = nn.LayerNorm(dim)
 
         self.apply(self._init_weights)
@@ -85,7 +87,7 @@ class Attention(nn.Module):
         B, N, C = x.shape
         q = self.q(x).reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
 
-        if self.sr_ratio > 1:
+        if max(self.sr_ratio) > 1:
             x_ = x.permute(0, 2, 1).reshape(B, C, H, W)
             x_ = self.sr(x_).reshape(B, C, -1).permute(0, 2, 1)
             x_ = self.norm(x_)
@@ -94,11 +96,9 @@ class Attention(nn.Module):
             kv = self.kv(x).reshape(B, -1, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         k, v = kv[0], kv[1]
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        # fused / memory efficient kernel when available on the device
+        x = F.scaled_dot_product_attention(q, k, v, dropout_p=self.attn_drop.p if self.training else 0.0, scale=self.scale)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
 
@@ -146,7 +146,7 @@ class Block(nn.Module):
 class VisionTransformer(nn.Module):
     def __init__(self, img_dim=(64, 1024), embed_dim=128, depth=4,
                  num_heads=4, mlp_ratio=2., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
-                 drop_path_rate=0., norm_layer=nn.LayerNorm, sr_ratio=1):
+                 drop_path_rate=0., norm_layer=nn.LayerNorm, sr_ratio=1, sr_ratios=None):
         super().__init__()
 
         self.embed_dim = embed_dim
@@ -157,10 +157,14 @@ class VisionTransformer(nn.Module):
 
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
 
+        # sr_ratios: reduction of each block, sr_ratio for all blocks otherwise
+        sr_ratios = sr_ratios or [sr_ratio] * depth
+        assert len(sr_ratios) == depth, 'one sr_ratio per block'
+
         self.blocks = nn.ModuleList([
             Block(
                 dim=self.embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer, sr_ratio=sr_ratio)
+                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer, sr_ratio=sr_ratios[i])
             for i in range(depth)])
 
         self.apply(self._init_weights)
@@ -180,11 +184,12 @@ class VisionTransformer(nn.Module):
             if m.bias is not None:
                 m.bias.data.zero_()
     
-    def forward(self, x):
+    def forward(self, x, img_dim=None):
+        H, W = img_dim or (self.H, self.W)
         for blk in self.blocks:
-            x = blk(x, self.H, self.W)
+            x = blk(x, H, W)
 
-        x = torch.reshape(x, (x.shape[0], self.H, self.W, x.shape[2]))
+        x = torch.reshape(x, (x.shape[0], H, W, x.shape[2]))
 
         return x
 
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# Importance of the retention heads of a trained RangeRet on the valid split and head pruning
+
+import os
+import copy
+import argparse
+from functools import partial
+import yaml
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from network.rangeret import RangeRet
+
+class HeadGates(object):
+    '''
+    Scale of the output of each retention head (1 by default), applied by forward hooks
+    on the head normalization of every MultiScaleRetention of the backbone
+    '''
+    def __init__(self, backbone):
+        self.gates = [torch.ones(retention.heads, device=retention.head_index.device, requires_grad=True)
+                      for retention in backbone.retentions]
+        self.handles = [retention.group_norm.register_forward_hook(partial(self.hook, gate))
+                        for retention, gate in zip(backbone.retentions, self.gates)]
+
+    @staticmethod
+    def hook(gate, module, inputs, output):
+        # output (bsz, seq_len, heads, head_size)
+        return output * gate.to(output)[:, None]
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+def batches(loader, device, max_scans):
+    for i, (proj_in, proj_mask, proj_labels, *_) in enumerate(tqdm(loader, total=min(len(loader), max_scans or len(loader)))):
+        if max_scans is not None and i == max_scans:
+            break
+        yield proj_in.to(device), proj_mask.to(device), proj_labels.to(device).long()
+
+def evaluate(model, loader, evaluator, device, max_scans=None):
+    '''
+    mIoU of the range image predictions (as in training validation)
+    '''
+    model.eval()
+    evaluator.reset()
+    with torch.no_grad():
+        for proj_in, proj_mask, proj_labels in batches(loader, device, max_scans):
+            evaluator.addBatch(model(proj_in, proj_mask).argmax(dim=-1), proj_labels)
+    return evaluator.getIoUMissingClass()[0].item()
+
+def miou_importance(model, gates, loader, evaluator, device, max_scans=None):
+    '''
+    Importance of each head: drop of mIoU when its output is removed
+    '''
+    base = evaluate(model, loader, evaluator, device, max_scans)
+    scores = []
+    for l, gate in enumerate(gates.gates):
+        scores.append([])
+        for h in range(gate.numel()):
+            print(f'Layer {l} head {h}')
+            gate.data[h] = 0
+            scores[-1].append(base - evaluate(model, loader, evaluator, device, max_scans))
+            gate.data[h] = 1
+    return base, scores
+
+def gradient_importance(model, gates, loader, ignore_label, device, max_scans=None):
+    '''
+    Importance of each head: expected absolute gradient of the cross entropy wrt its gate
+    ("Are Sixteen Heads Really Better than One?"), normalized per layer
+    '''
+    model.eval()
+    model.requires_grad_(False)
+    scores = [torch.zeros_like(gate) for gate in gates.gates]
+    for proj_in, proj_mask, proj_labels in batches(loader, device, max_scans):
+        predictions = model(proj_in, proj_mask).permute(0, 3, 1, 2)
+        F.cross_entropy(predictions, proj_labels, ignore_index=ignore_label).backward()
+        for score, gate in zip(scores, gates.gates):
+            score += gate.grad.abs()
+            gate.grad = None
+    return [(score / score.norm()).tolist() for score in scores]
+
+def select_heads(scores, num_prune, score_sharing=None):
+    '''
+    Heads (positions in each layer) kept after removing the num_prune least important heads
+    of all the layers, at least one head is kept per layer. Layers of a score_sharing group keep
+    the same heads: a head of a group is ranked by its importance summed over the layers of the
+    group and removing it removes one head per layer
+    '''
+    groups = [sorted(group) for group in score_sharing or []]
+    grouped = {l for group in groups for l in group}
+    groups += [[l] for l in range(len(scores)) if l not in grouped]
+
+    kept = [list(range(len(layer))) for layer in scores]
+    ranking = sorted((sum(scores[l][h] for l in group), group, h) for group in groups for h in range(len(scores[group[0]])))
+    for _, group, h in ranking:
+        if num_prune == 0:
+            break
+        if len(kept[group[0]]) > 1 and len(group) <= num_prune:
+            for l in group:
+                kept[l].remove(h)
+            num_prune -= len(group)
+    return kept
+
+def prune_state_dict(model, kept):
+    '''
+    State dict of model with only the kept heads in each retention: rows of the fused q, k, v
+    (and gate) projection and columns of the output projection
+    '''
+    state = model.state_dict()
+    for l, (retention, heads) in enumerate(zip(model.backbone.retentions, kept)):
+        def rows(offset, dim):
+            return [offset + h * dim + i for h in heads for i in range(dim)]
+        q = rows(0, retention.key_dim)
+        k = rows(retention.qk_dim, retention.key_dim)
+        v = rows(2 * retention.qk_dim, retention.head_size)
+        g = rows(2 * retention.qk_dim + retention.v_dim, retention.head_size) if retention.gate else []
+
+        prefix = f'backbone.retentions.{l}.'
+        state[prefix + 'qkv_proj.weight'] = state[prefix + 'qkv_proj.weight'][q + k + v + g].clone()
+        state[prefix + 'out_proj.weight'] = state[prefix + 'out_proj.weight'][:, rows(0, retention.head_size)].clone()
+    return state
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("./prune_heads.py")
+    parser.add_argument(
+        '--dataset', '-d',
+        type=str,
+        required=True,
+        help='Dataset to score the heads on (valid split)',
+    )
+    parser.add_argument(
+        '--config',
+        type=str,
+        required=False,
+        default='config/RangeRet-semantickitti.yaml',
+        help='Architecture yaml cfg file. See /config/ for sample. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--data',
+        type=str,
+        default='config/labels/semantic-kitti.yaml',
+        help='Dataset yaml cfg file. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--model', '-m',
+        type=str,
+        required=True,
+        help='Trained model to prune',
+    )
+    parser.add_argument(
+        '--log', '-l',
+        type=str,
+        required=True,
+        help='Directory where the pruned model and its config are written',
+    )
+    parser.add_argument(
+        '--method',
+        type=str,
+        default='gradient',
+        choices=['gradient', 'miou'],
+        help='Head importance: gradient of the loss wrt a gate on each head (one pass) or mIoU drop '
+             'when the head is removed (one evaluation per head). Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--prune',
+        type=int,
+        default=4,
+        help='Number of heads removed over all the layers. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--max_scans',
+        type=int,
+        default=None,
+        help='Score the heads on the first max_scans scans of the valid split only',
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+
+    ARCH = yaml.safe_load(open(FLAGS.config, 'r'))
+    DATA = yaml.safe_load(open(FLAGS.data, 'r'))
+    assert ARCH['model_params']['backbone'] == 'retnet' and ARCH['model_params']['retnet'].get('stages') is None, \
+        'head pruning needs the single stage RetNet'
+
+    from modules.user import User
+    user = User(ARCH, DATA, FLAGS.dataset, None, FLAGS.model, 'valid')
+    model, device = user.model, user.device
+    loader = user.parser.get_valid_set()
+
+    gates = HeadGates(model.backbone)
+    if FLAGS.method == 'miou':
+        base, scores = miou_importance(model, gates, loader, user.evaluator, device, FLAGS.max_scans)
+    else:
+        base = evaluate(model, loader, user.evaluator, device, FLAGS.max_scans)
+        scores = gradient_importance(model, gates, loader, ARCH['dataset']['ignore_label'], device, FLAGS.max_scans)
+    gates.remove()
+
+    print('{:>6} {}'.format('layer', 'head importance'))
+    for l, layer in enumerate(scores):
+        print('{:>6} {}'.format(l, ' '.join('{:>8.4f}'.format(score) for score in layer)))
+
+    kept = select_heads(scores, FLAGS.prune, ARCH['model_params']['retnet'].get('score_sharing'))
+    # heads of the original model (the model may already be pruned)
+    kept_heads = [retention.head_index[heads].tolist() for retention, heads in zip(model.backbone.retentions, kept)]
+    print('Kept heads', kept_heads)
+
+    arch = copy.deepcopy(ARCH)
+    arch['model_params']['retnet']['kept_heads'] = kept_heads
+    pruned = RangeRet(arch['model_params'], user.parser.get_resolution(), user.parser.get_n_classes())
+    pruned.load_state_dict(prune_state_dict(model, kept), strict=True)
+    pruned.to(device)
+    iou = evaluate(pruned, loader, user.evaluator, device, FLAGS.max_scans)
+    print('mIoU before pruning: {:.2%} | after pruning: {:.2%}'.format(base, iou))
+
+    os.makedirs(FLAGS.log, exist_ok=True)
+    name = f"{arch['model_params']['model_architecture']}-pruned"
+    torch.save(pruned.state_dict(), os.path.join(FLAGS.log, f'{name}.pt'))
+    with open(os.path.join(FLAGS.log, f'{name}.yaml'), 'w') as f:
+        yaml.safe_dump(arch, f, sort_keys=False)
+    print(f'Pruned model and config saved in {FLAGS.log}')
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# Post-training INT8 quantization of a trained RangeRet for cpu inference
+
+import copy
+import argparse
+import yaml
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Subset
+import torch.ao.nn.qat as nnqat
+from torch.ao.quantization import (QConfig, QuantWrapper, get_default_qconfig, get_default_qat_qconfig, prepare, prepare_qat,
+                                   convert, quantize_dynamic, default_weight_fake_quant, default_fixed_qparams_range_0to1_fake_quant)
+from tqdm import tqdm
+
+from export import export
+from network.msr import MultiScaleRetention
+from utils.ioueval import iouEval
+
+def subset(loader, num_scans):
+    '''
+    Loader of the first num_scans scans of the dataset of loader (all of them if None)
+    '''
+    if num_scans is None:
+        return loader
+    dataset = Subset(loader.dataset, range(min(num_scans, len(loader.dataset))))
+    return DataLoader(dataset, batch_size=1, shuffle=False, num_workers=loader.num_workers)
+
+def float_layer(name, float_layers):
+    '''
+    Whether the module name stays float: listed in float_layers or inside a listed module
+    '''
+    return any(name == layer or name.startswith(layer + '.') for layer in float_layers)
+
+def replace_module(model, name, module):
+    parent, _, child = name.rpartition('.')
+    setattr(model.get_submodule(parent), child, module)
+
+def static_layers(float_layers=()):
+    '''
+    Names of the statically quantized modules: the conv stem and the patch embedding convolution,
+    each one quantized (or kept float) as a whole
+    '''
+    layers = ['rem', 'viembed.proj']
+    assert not any(layer.startswith(static + '.') for layer in float_layers for static in layers), \
+        'the conv stem (rem) and the patch embedding (viembed.proj) are quantized as a whole'
+    return [layer for layer in layers if not float_layer(layer, float_layers)]
+
+def dynamic_linears(model, float_layers=()):
+    '''
+    Names of the nn.Linear of the retentions, feed-forward networks and semantic head. The
+    fused q, k, v projection is skipped when token merging or score sharing read its weight
+    '''
+    backbone = model.backbone
+    keep_qkv = not any(getattr(backbone, 'merge_ratio', [])) and all(g is None for g in getattr(backbone, 'share_group', []))
+    return {name for name, module in model.named_modules()
+            if isinstance(module, nn.Linear) and name.startswith(('backbone.', 'head.'))
+            and (keep_qkv or not name.endswith('qkv_proj')) and not float_layer(name, float_layers)}
+
+def prepare_quantization(model, engine='x86', float_layers=(), qat=False, scores=False):
+    '''
+    Wraps the conv stem and the patch embedding convolution of model (in place) in QuantWrapper,
+    with observers to calibrate them after training or with fake quantization for quantization
+    aware training (qat). With qat the weights of the nn.Linear dynamically quantized at conversion
+    are fake quantized too, and the softmax scores of the dense retentions if scores.
+    Modules in float_layers stay float. Returns the names of the dynamically quantized nn.Linear
+    '''
+    torch.backends.quantized.engine = engine
+    linears = dynamic_linears(model, float_layers)
+    for name in static_layers(float_layers):
+        wrapper = QuantWrapper(model.get_submodule(name))
+        wrapper.qconfig = get_default_qat_qconfig(engine) if qat else get_default_qconfig(engine)
+        for module in wrapper.modules():
+            if isinstance(module, nn.LeakyReLU):
+                # quantized leaky_relu has no in place variant (stem of a fused model)
+                module.inplace = False
+        replace_module(model, name, wrapper)
+
+    if not qat:
+        prepare(model, inplace=True)
+        return linears
+
+    # activations of the dynamically quantized nn.Linear are quantized on the fly, only their weights are simulated
+    for name in linears:
+        model.get_submodule(name).qconfig = QConfig(activation=nn.Identity, weight=default_weight_fake_quant)
+    if scores:
+        for module in model.modules():
+            if isinstance(module, MultiScaleRetention):
+                module.score_quant = default_fixed_qparams_range_0to1_fake_quant()
+    prepare_qat(model, inplace=True)
+    return linears
+
+def convert_quantization(model, linears):
+    '''
+    INT8 model (in place, on cpu in eval mode) from a model prepared by prepare_quantization: the
+    wrapped modules are converted with their calibrated (or trained) ranges, the nn.Linear in linears
+    are dynamically quantized and the scores go back to float
+    '''
+    for name in linears:
+        module = model.get_submodule(name)
+        if isinstance(module, nnqat.Linear):
+            replace_module(model, name, module.to_float())
+    for module in model.modules():
+        if isinstance(module, MultiScaleRetention):
+            module.score_quant = nn.Identity()
+    convert(model, inplace=True)
+    return quantize_dynamic(model, linears, dtype=torch.qint8, inplace=True)
+
+def quantize(model, calibration_loader, engine='x86', float_layers=()):
+    '''
+    INT8 copy of model (cpu): the conv stem and the patch embedding convolution are statically
+    quantized with activation ranges calibrated on calibration_loader, the nn.Linear of the
+    retentions, feed-forward networks and semantic head are dynamically quantized (int8 weights,
+    activations quantized on the fly). The CiR softmax, normalizations and depthwise convs stay float,
+    as the modules in float_layers
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    linears = prepare_quantization(model, engine, float_layers)
+
+    with torch.no_grad():
+        for proj_in, proj_mask, *_ in tqdm(calibration_loader, desc='Calibration'):
+            model(proj_in, proj_mask)
+    return convert_quantization(model, linears)
+
+def evaluate(user, model, loader):
+    '''
+    Per class IoU and time per scan (s) of model through the inference pipeline of user on cpu
+    (KNN post-processing included, on cpu too)
+    '''
+    user.model, user.gpu = model, False
+    user.evaluator = iouEval(user.parser.get_n_classes(), torch.device('cpu'), user.ARCH['dataset']['ignore_label'])
+    user.infer_subset(loader=loader, to_orig_fn=user.parser.to_original, evaluator=user.evaluator)
+    iou, class_iou = user.evaluator.getIoU()
+    return iou.item(), class_iou.tolist(), user.time_per_scan
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("./quantize.py")
+    parser.add_argument(
+        '--dataset', '-d',
+        type=str,
+        required=True,
+        help='Dataset to calibrate (train split) and evaluate (valid split) on',
+    )
+    parser.add_argument(
+        '--config',
+        type=str,
+        required=False,
+        default='config/RangeRet-semantickitti.yaml',
+        help='Architecture yaml cfg file. See /config/ for sample. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--data',
+        type=str,
+        default='config/labels/semantic-kitti.yaml',
+        help='Dataset yaml cfg file. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--model', '-m',
+        type=str,
+        required=True,
+        help='Trained model to quantize',
+    )
+    parser.add_argument(
+        '--output', '-o',
+        type=str,
+        required=True,
+        help='Quantized model (TorchScript .ts, loaded by infer.py --model)',
+    )
+    parser.add_argument(
+        '--calibration_scans',
+        type=int,
+        default=100,
+        help='Scans of the train split used to calibrate the activation ranges. Defaults to %(default)s',
+    )
+    parser.add_argument(
+        '--eval_scans',
+        type=int,
+        default=None,
+        help='Scans of the valid split used to compare the float and int8 models. Defaults to all of them',
+    )
+    parser.add_argument(
+        '--engine',
+        type=str,
+        default=None,
+        choices=torch.backends.quantized.supported_engines,
+        help='Quantized engine (x86 or fbgemm on x86 cpus, qnnpack on arm). Defaults to the engine of the config',
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+
+    assert FLAGS.output.endswith('.ts'), 'the quantized model is saved as TorchScript (.ts)'
+    ARCH = yaml.safe_load(open(FLAGS.config, 'r'))
+    DATA = yaml.safe_load(open(FLAGS.data, 'r'))
+
+    from modules.user import User
+    user = User(ARCH, DATA, FLAGS.dataset, None, FLAGS.model, 'valid')
+    model = user.model.cpu().eval()
+    # calibrated on held-out scans of the train split, evaluated on the valid split
+    train_set = user.parser.get_train_set()
+    valid_set = user.parser.get_valid_set()
+    resolution = user.parser.get_resolution()
+
+    quantization = ARCH['model_params'].get('quantization', {})
+    engine = FLAGS.engine or quantization.get('engine', 'x86')
+    quantized = quantize(model, subset(train_set, FLAGS.calibration_scans), engine, quantization.get('float_layers') or [])
+    # traced on cpu with the rel-pos tables baked in, as the exported TorchScript models
+    traced = export(quantized, resolution, format='torchscript')
+    traced.save(FLAGS.output, _extra_files={'device': 'cpu', 'engine': engine})
+    print(f'Quantized model saved in {FLAGS.output}')
+
+    loader = subset(valid_set, FLAGS.eval_scans)
+    float_iou, float_class_iou, float_time = evaluate(user, model, loader)
+    int8_iou, int8_class_iou, int8_time = evaluate(user, traced, loader)
+
+    print('{:>15} {:>8} {:>8} {:>8}'.format('class', 'float', 'int8', 'delta'))
+    for i, (f, q) in enumerate(zip(float_class_iou, int8_class_iou)):
+        if i in user.evaluator.include:
+            print('{:>15} {:>8.2%} {:>8.2%} {:>+8.2%}'.format(user.parser.get_xentropy_class_string(i), f, q, q - f))
+    print('{:>15} {:>8.2%} {:>8.2%} {:>+8.2%}'.format('mIoU', float_iou, int8_iou, int8_iou - float_iou))
+    print('Time per scan (cpu): float {:.1f} ms | int8 {:.1f} ms'.format(float_time * 1000, int8_time * 1000))
@@ -73,6 +73,12 @@ if __name__ == '__main__':
         default=False,
         help='Use mixed precision training. Default: False'
     )
+    parser.add_argument(
+        '--qat',
+        action='store_true',
+        default=False,
+        help='Quantization aware fine-tuning of the float --checkpoint, exports an INT8 model (see quantization in the config). Default: False'
+    )
     FLAGS, unparsed = parser.parse_known_args()
 
     # print summary of what we will do
@@ -85,6 +91,7 @@ if __name__ == '__main__':
     print("checkpoint", FLAGS.checkpoint)
     print("pretrained retnet", FLAGS.pretrained_model)
     print("fp16", FLAGS.fp16)
+    print("qat", FLAGS.qat)
     print("----------\n")
     #print("Commit hash (training version): ", str(
     #    subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()))
@@ -138,5 +145,5 @@ if __name__ == '__main__':
         print("Error copying files, check permissions. Exiting...")
         quit()
 
-    trainer = Trainer(ARCH, DATA, FLAGS.dataset, FLAGS.log, FLAGS.checkpoint, FLAGS.pretrained_model, FLAGS.fp16)
+    trainer = Trainer(ARCH, DATA, FLAGS.dataset, FLAGS.log, FLAGS.checkpoint, FLAGS.pretrained_model, FLAGS.fp16, FLAGS.qat)
     trainer.train()
\ No newline at end of file
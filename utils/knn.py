@@ -56,11 +56,8 @@ class KNN(nn.Module):
         If they come batched we need to iterate over the batch dimension or do
         something REALLY smart to handle unaligned number of points in memory
     '''
-    # get device
-    if proj_range.is_cuda:
-      device = torch.device("cuda")
-    else:
-      device = torch.device("cpu")
+    # get device (cpu with the onnxruntime backend)
+    device = proj_range.device
 
     proj_range = torch.squeeze(proj_range, 0)
     unproj_range = torch.squeeze(unproj_range, 0)
@@ -124,7 +121,7 @@ class KNN(nn.Module):
 
     # get the top k predictions from the knn at each pixel
     knn_argmax = torch.gather(
-        input=unproj_unfold_1_argmax.cuda(), dim=1, index=knn_idx.cuda())
+        input=unproj_unfold_1_argmax.to(device), dim=1, index=knn_idx.to(device))
 
     # fake an invalid argmax of classes + 1 for all cutoff items
     if self.cutoff > 0: